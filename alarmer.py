@@ -1,12 +1,18 @@
 __author__ = 'Altertech, https://www.altertech.com/'
 __copyright__ = 'Copyright (C) 2012-2020 Altertech'
 __license__ = 'Apache License 2.0'
-__version__ = '0.0.3'
+__version__ = '0.0.4'
 
 import eva.pluginapi as pa
 import sqlalchemy as sa
 import threading
+import queue
 import time
+import hashlib
+import re
+import json
+import collections
+import itertools
 
 from neotasker import g, background_worker
 
@@ -20,27 +26,354 @@ import eva.core
 sql = sa.text
 
 from types import SimpleNamespace
-db_lock = threading.RLock()
-flags = SimpleNamespace(ready=False, db=None)
+flags = SimpleNamespace(ready=False, db=None, migrate_log=False)
+
+SCHEMA_VERSION = 2
+# records copied per transaction during schema migrations
+MIGRATE_CHUNK = 1000
+# max alarms listed in notification digest
+DIGEST_MAX_ALARMS = 100
+# max jobs put from notification spool into the queue at once
+SPOOL_REQUEUE_MAX = 1000
+# alarms processed at once by bulk export and import
+BULK_CHUNK = 100
+# alarm statistics rollup periods (seconds)
+STATS_PERIODS = (3600, 86400)
+# histogram buckets for timing metrics (seconds)
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+
+METRICS_HELP = {
+    'alarmer_triggers_total': ('counter', 'Alarm triggers processed'),
+    'alarmer_triggers_coalesced_total':
+        ('counter', 'Alarm triggers coalesced by trigger window'),
+    'alarmer_triggers_skipped_total':
+        ('counter', 'Alarm triggers without notifications'),
+    'alarmer_acks_total': ('counter', 'Alarm acknowledgements'),
+    'alarmer_notify_seconds': ('histogram', 'Alarm trigger processing time'),
+    'alarmer_notify_phase_seconds':
+        ('histogram', 'Alarm trigger processing time by phase'),
+    'alarmer_delivery_seconds':
+        ('histogram', 'Notification delivery time by channel'),
+    'alarmer_delivery_phase_seconds':
+        ('histogram', 'Notification delivery time by channel and phase'),
+    'alarmer_mail_seconds': ('histogram', 'Mailer call time'),
+    'alarmer_db_connect_seconds':
+        ('histogram', 'Time to get a database connection from the pool'),
+    'alarmer_db_write_seconds':
+        ('histogram', 'Batched database write time by writer'),
+    'alarmer_log_clean_seconds': ('histogram', 'Alarm log cleaning time'),
+    'alarmer_notifications_sent_total':
+        ('counter', 'Notification jobs delivered by channel'),
+    'alarmer_notifications_failed_total':
+        ('counter', 'Notification job delivery failures by channel'),
+    'alarmer_notifications_dropped_total':
+        ('counter', 'Notification jobs dropped on queue overflow by channel'),
+    'alarmer_notification_queue':
+        ('gauge', 'Notification jobs waiting for senders by channel'),
+    'alarmer_writer_queue': ('gauge', 'Records waiting to be written'),
+    'alarmer_writer_written_total': ('counter', 'Records written'),
+    'alarmer_writer_failed_total': ('counter', 'Records failed to be written'),
+    'alarmer_spool_inflight': ('gauge', 'Spooled jobs queued or being sent'),
+    'alarmer_spool_retries_total': ('counter', 'Spooled job retries'),
+    'alarmer_spool_expired_total':
+        ('counter', 'Spooled jobs given up after max attempts'),
+    'alarmer_log_purged_total': ('counter', 'Expired alarm log records purged'),
+    'alarmer_digest_recipients':
+        ('gauge', 'Recipients with pending notification digests'),
+    'alarmer_event_waiting': ('gauge', 'Clients waiting for alarm events'),
+    'alarmer_state_cache_hits_total': ('counter', 'Alarm state cache hits'),
+    'alarmer_state_cache_misses_total': ('counter', 'Alarm state cache misses')
+}
 
 logger = pa.get_logger()
 
 
+class PhaseTimer:
+    """
+    Measures time of the operation and its phases
+
+    Phase times are observed as <name>_phase_seconds, the total time as
+    <name>_seconds
+    """
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.t_start = self.t = time.perf_counter()
+
+    def phase(self, phase):
+        t = time.perf_counter()
+        metrics.observe(f'{self.name}_phase_seconds',
+                        t - self.t,
+                        phase=phase,
+                        **self.labels)
+        self.t = t
+
+    def done(self):
+        metrics.observe(f'{self.name}_seconds',
+                        time.perf_counter() - self.t_start, **self.labels)
+
+
+class NullTimer:
+
+    def phase(self, phase):
+        pass
+
+    def done(self):
+        pass
+
+
+null_timer = NullTimer()
+
+
+class Metrics:
+    """
+    Plugin metrics
+
+    Counters and histograms of the hot paths are collected only if metrics
+    are enabled, otherwise the methods return immediately (timers are no-op).
+    Component counters and queue depths are taken from their stats when
+    metrics are requested.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [bucket counts..., sum, count]
+        self.histograms = {}
+
+    def inc(self, name, n=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            try:
+                h = self.histograms[key]
+            except KeyError:
+                h = self.histograms[key] = [0] * (len(METRICS_BUCKETS) + 2)
+            for i, le in enumerate(METRICS_BUCKETS):
+                if value <= le:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    def timer(self, name, **labels):
+        return PhaseTimer(name, labels) if self.enabled else null_timer
+
+    def collect(self):
+        """
+        Returns metrics as dict name -> {'type', 'help', 'values'}
+        """
+        result = {}
+
+        def add(name, value, **labels):
+            tp, help_text = METRICS_HELP[name]
+            result.setdefault(name, {
+                'type': tp,
+                'help': help_text,
+                'values': []
+            })['values'].append({'labels': labels, 'value': value})
+
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(k, v.copy()) for k, v in self.histograms.items()]
+        for (name, labels), value in counters:
+            add(name, value, **dict(labels))
+        for (name, labels), h in histograms:
+            tp, help_text = METRICS_HELP[name]
+            buckets = {}
+            n = 0
+            for le, c in zip(METRICS_BUCKETS, h):
+                n += c
+                buckets[str(le)] = n
+            buckets['+Inf'] = h[-1]
+            result.setdefault(name, {
+                'type': tp,
+                'help': help_text,
+                'values': []
+            })['values'].append({
+                'labels': dict(labels),
+                'buckets': buckets,
+                'sum': h[-2],
+                'count': h[-1]
+            })
+        for c in channels.values():
+            st = c.dispatcher.serialize()
+            add('alarmer_notifications_sent_total', st['sent'], channel=c.name)
+            add('alarmer_notifications_failed_total',
+                st['failed'],
+                channel=c.name)
+            add('alarmer_notifications_dropped_total',
+                st['dropped'],
+                channel=c.name)
+            add('alarmer_notification_queue', st['queue'], channel=c.name)
+        writers = [('log', log_writer)]
+        if pa.get_product().code == 'lm':
+            writers.append(('spool', spool))
+            add('alarmer_spool_inflight', len(spool.inflight))
+            add('alarmer_spool_retries_total', spool.retries)
+            add('alarmer_spool_expired_total', spool.expired)
+            add('alarmer_log_purged_total', log_cleaner_stats.purged)
+            add('alarmer_digest_recipients', len(digest.pending))
+        for label, w in writers:
+            add('alarmer_writer_queue', len(w.buf), writer=label)
+            add('alarmer_writer_written_total', w.written, writer=label)
+            add('alarmer_writer_failed_total', w.failed, writer=label)
+        add('alarmer_event_waiting', event_bus.waiting)
+        add('alarmer_state_cache_hits_total', state_cache.hits)
+        add('alarmer_state_cache_misses_total', state_cache.misses)
+        return result
+
+    def render(self):
+        """
+        Renders metrics in Prometheus text exposition format
+        """
+
+        def fmt_labels(labels, **extra):
+            labels = dict(labels, **extra)
+            if not labels:
+                return ''
+            values = []
+            for k, v in labels.items():
+                v = str(v).replace('\\', '\\\\').replace('"', '\\"')
+                values.append(f'{k}="{v}"')
+            return '{' + ','.join(values) + '}'
+
+        lines = []
+        for name, m in sorted(self.collect().items()):
+            lines.append(f'# HELP {name} {m["help"]}')
+            lines.append(f'# TYPE {name} {m["type"]}')
+            for v in m['values']:
+                labels = v['labels']
+                if m['type'] == 'histogram':
+                    for le, c in v['buckets'].items():
+                        lines.append(
+                            f'{name}_bucket{fmt_labels(labels, le=le)} {c}')
+                    lines.append(f'{name}_sum{fmt_labels(labels)} {v["sum"]}')
+                    lines.append(
+                        f'{name}_count{fmt_labels(labels)} {v["count"]}')
+                else:
+                    lines.append(f'{name}{fmt_labels(labels)} {v["value"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes metrics text file (e.g. for node exporter textfile collector)
+        """
+        import os
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(self.render())
+        os.replace(tmp, path)
+
+
+metrics = Metrics()
+
+
 # undocummented thread-local, don't use in own plugins
 def get_db():
-    with db_lock:
-        if not g.has('x_alarmer_db'):
-            g.x_alarmer_db = flags.db.connect()
-        else:
+    """
+    Returns thread-local database connection
+
+    The connection is checked with "select 1" only if it was idle for more
+    than db_ping_after seconds, connections invalidated by SQLAlchemy after
+    errors are replaced with the new ones
+    """
+    db = g.get('x_alarmer_db')
+    t = time.monotonic()
+    if db is not None and not db.closed and not db.invalidated:
+        if t - g.x_alarmer_db_t < flags.db_ping_after:
+            g.x_alarmer_db_t = t
+            return db
+        try:
+            db.execute('select 1')
+            g.x_alarmer_db_t = t
+            return db
+        except:
+            pass
+    if db is not None:
+        reset_db()
+    timer = metrics.timer('alarmer_db_connect')
+    db = flags.db.connect()
+    timer.done()
+    g.x_alarmer_db = db
+    g.x_alarmer_db_t = t
+    return db
+
+
+def reset_db():
+    """
+    Closes thread-local database connection, the next get_db() call opens
+    a new one
+    """
+    db = g.get('x_alarmer_db')
+    g.clear('x_alarmer_db')
+    if db is not None:
+        try:
+            db.close()
+        except:
+            pass
+
+
+def val_to_boolean(val):
+    if isinstance(val, bool):
+        return val
+    return str(val).lower() in ('1', 'true', 'yes', 'on', 'y')
+
+
+def create_engine(db, config):
+    """
+    Creates SQLAlchemy engine
+
+    For SQLite, pragmas are set for each new connection. For other databases
+    with db_pool_size set, the engine is created with a connection pool,
+    otherwise the default EVA ICS engine is used
+    """
+    # undocummented internal function, don't use in own plugins
+    from eva.core import create_db_engine
+    pool_size = int(config.get('db_pool_size', 0))
+    logger.debug(f'alarmer.db_pool_size = {pool_size}')
+    if db.startswith('sqlite'):
+        engine = create_db_engine(db)
+        wal = val_to_boolean(config.get('sqlite_wal', True))
+        logger.debug(f'alarmer.sqlite_wal = {wal}')
+        busy_timeout = int(config.get('sqlite_busy_timeout', 5000))
+        logger.debug(f'alarmer.sqlite_busy_timeout = {busy_timeout}')
+
+        @sa.event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(conn, rec):
+            cursor = conn.cursor()
             try:
-                g.x_alarmer_db.execute('select 1')
-            except:
-                try:
-                    g.userdb.close()
-                except:
-                    pass
-                g.x_alarmer_db = flags.db.connect()
-        return g.x_alarmer_db
+                cursor.execute(f'pragma busy_timeout={busy_timeout}')
+                if wal:
+                    cursor.execute('pragma journal_mode=WAL')
+                    cursor.execute('pragma synchronous=NORMAL')
+            finally:
+                cursor.close()
+
+    elif pool_size:
+        max_overflow = int(config.get('db_pool_overflow', -1))
+        logger.debug(f'alarmer.db_pool_overflow = {max_overflow}')
+        pool_recycle = int(config.get('db_pool_recycle', 3600))
+        logger.debug(f'alarmer.db_pool_recycle = {pool_recycle}')
+        engine = sa.create_engine(db,
+                                  pool_size=pool_size,
+                                  max_overflow=max_overflow,
+                                  pool_recycle=pool_recycle)
+    else:
+        engine = create_db_engine(db)
+    return engine
 
 
 def get_level_name(level):
@@ -49,72 +382,1671 @@ def get_level_name(level):
 
 def notify(alarm_id, level):
     level = int(level)
-    lv = pa.api_call('state', i=f'lvar:alarmer/{alarm_id}', full=True)
-    db = get_db()
+    timer = metrics.timer('alarmer_notify')
+    try:
+        t = trigger_gate.coalesce(alarm_id, level)
+        if t is not None:
+            log_writer.add_hit(alarm_id, t)
+            logger.debug(f'Alarm trigger coalesced: {alarm_id}')
+            metrics.inc('alarmer_triggers_coalesced_total')
+            return
+        metrics.inc('alarmer_triggers_total', level=level)
+        lv = state_cache.get(alarm_id)
+        timer.phase('state')
+        t = time.time()
+        log_writer.append(u='',
+                          utp='',
+                          key_id='',
+                          alarm_id=alarm_id,
+                          description=lv['description'],
+                          action='T',
+                          t=t,
+                          level=level)
+        trigger_gate.logged(alarm_id, level, t)
+        timer.phase('log')
+        try:
+            if lv['status'] == 1:
+                cur_value = lv['value']
+                if cur_value:
+                    cur_value = int(cur_value)
+                else:
+                    cur_value = 0
+                if cur_value >= level:
+                    logger.info('Skipping alarm notifications, '
+                                f'already triggered: {alarm_id}')
+                    metrics.inc('alarmer_triggers_skipped_total',
+                                reason='already_triggered')
+                else:
+                    # the cache is updated first, so the state event is not
+                    # considered as the external change
+                    prev_value = lv['value']
+                    state_cache.set_value(alarm_id, level)
+                    try:
+                        pa.api_call('set',
+                                    i=f'lvar:alarmer/{alarm_id}',
+                                    v=level)
+                    except:
+                        state_cache.set_value(alarm_id, prev_value)
+                        raise
+                    timer.phase('lvar')
+                    event_bus.publish(alarm_id=alarm_id,
+                                      action='T',
+                                      level=level,
+                                      description=lv['description'],
+                                      t=t)
+                    logger.warning(f'Alarm triggered: {alarm_id}, '
+                                   f'level: {get_level_name(level)}')
+                    if trigger_gate.may_notify(alarm_id, level):
+                        dispatch(
+                            SimpleNamespace(alarm_id=alarm_id,
+                                            level=level,
+                                            description=lv['description'],
+                                            t=t))
+                        timer.phase('dispatch')
+                    else:
+                        logger.info('Skipping alarm notifications, '
+                                    f'notified recently: {alarm_id}')
+                        metrics.inc('alarmer_triggers_skipped_total',
+                                    reason='notified_recently')
+            else:
+                logger.debug(f'Inactive alarm triggered: {alarm_id}')
+                metrics.inc('alarmer_triggers_skipped_total', reason='inactive')
+        except:
+            logger.error(f'Unable to process alarm: {alarm_id}')
+            pa.log_traceback()
+            raise
+    finally:
+        # coalesced and failed triggers are timed as well
+        timer.done()
+
+
+def value_to_level(value):
+    try:
+        return int(value) if value else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+def get_lvar_level(lvar):
+    if not lvar or lvar.status != 1:
+        return None
+    return value_to_level(lvar.value)
+
+
+class StateCache:
+    """
+    Alarm lvar state cache
+
+    alarm_id -> {'description': ..., 'status': ..., 'value': ...}
+
+    The cache is seeded at startup, updated by the plugin itself and by lvar
+    state events. As description changes do not produce state events, cached
+    entries are re-read with "state" API call after state_cache_ttl seconds.
+    If state_cache_check is enabled, each cached state is compared with the
+    one returned by API (for testing only).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+
+    @staticmethod
+    def _fetch(alarm_id):
+        lv = pa.api_call('state', i=f'lvar:alarmer/{alarm_id}', full=True)
+        return {
+            'description': lv.get('description', ''),
+            'status': lv.get('status'),
+            'value': lv.get('value'),
+            't': time.monotonic()
+        }
+
+    def seed(self):
+        t = time.monotonic()
+        states = {}
+        for lv in pa.api_call('state', p='lvar', g='alarmer/#', full=True):
+            states[lv['oid'].split(':', 1)[-1][8:]] = {
+                'description': lv.get('description', ''),
+                'status': lv.get('status'),
+                'value': lv.get('value'),
+                't': t
+            }
+        with self.lock:
+            self.states = states
+        logger.debug(f'alarmer state cache seeded, {len(states)} alarms')
+
+    def get(self, alarm_id):
+        st = self.states.get(alarm_id)
+        if st is None or time.monotonic() - st['t'] > flags.state_cache_ttl:
+            st = self._fetch(alarm_id)
+            with self.lock:
+                self.states[alarm_id] = st
+                self.misses += 1
+        else:
+            with self.lock:
+                self.hits += 1
+        if flags.state_cache_check:
+            self.check(alarm_id, st)
+        return st
+
+    def get_level(self, alarm_id):
+        st = self.get(alarm_id)
+        if st['status'] != 1:
+            return None
+        return value_to_level(st['value'])
+
+    def check(self, alarm_id, st):
+        lv = self._fetch(alarm_id)
+        for k in ('description', 'status', 'value'):
+            if str(lv[k]) != str(st[k]):
+                with self.lock:
+                    self.mismatches += 1
+                logger.warning(f'alarmer state cache mismatch for {alarm_id}, '
+                               f'{k}: {st[k]} (cached) != {lv[k]} (api)')
+
+    def set_value(self, alarm_id, value):
+        with self.lock:
+            st = self.states.get(alarm_id)
+            if st:
+                st['value'] = str(value)
+
+    def update(self, alarm_id, data):
+        """
+        Updates cached state, returns the previous state (None if the alarm is
+        not cached)
+        """
+        with self.lock:
+            st = self.states.get(alarm_id)
+            if st:
+                prev = st.copy()
+                for k in ('description', 'status', 'value'):
+                    if k in data:
+                        st[k] = data[k]
+                return prev
+
+    def drop(self, alarm_id):
+        with self.lock:
+            self.states.pop(alarm_id, None)
+
+    def serialize(self):
+        return {
+            'alarms': len(self.states),
+            'hits': self.hits,
+            'misses': self.misses,
+            'mismatches': self.mismatches
+        }
+
+
+state_cache = StateCache()
+
+
+def handle_state_event(source, data, **kwargs):
     try:
-        db.execute(sql(
-            'insert into alarmer_log'
-            '(u, utp, key_id, alarm_id, description, action, t, level)'
-            'values (:u, :utp, :key_id, :alarm_id, :d, :action, :t, :level)'),
-                   u='',
-                   utp='',
-                   key_id='',
-                   alarm_id=alarm_id,
-                   d=lv['description'],
-                   action='T',
-                   t=time.time(),
-                   level=level)
+        if source.item_type == 'lvar' and \
+                source.full_id.startswith('alarmer/'):
+            alarm_id = source.full_id[8:]
+            prev = state_cache.update(alarm_id, data)
+            if 'value' in data:
+                # alarm level changes, made outside of this controller
+                level = value_to_level(data['value'])
+                prev_level = value_to_level(prev['value']) if prev else 0
+                if level != prev_level and (level or prev_level):
+                    event_bus.publish(
+                        alarm_id=alarm_id,
+                        action='T' if level > prev_level else 'A',
+                        level=level,
+                        description=prev['description']
+                        if prev else source.description)
     except:
-        logger.error(f'Unable to insert log record for alarm: {alarm_id}')
         pa.log_traceback()
-    try:
-        if lv['status'] == 1:
-            cur_value = lv['value']
-            if cur_value:
-                cur_value = int(cur_value)
-            else:
-                cur_value = 0
-            if cur_value >= level:
-                logger.info('Skipping alarm notifications, '
-                            f'already triggered: {alarm_id}')
+
+
+class EventBus:
+    """
+    In-process bus of alarm events (triggers and acknowledgements)
+
+    Events are kept in a ring buffer of event_buffer_size records, each event
+    gets a sequence number. Clients request events after the last seen
+    sequence number and wait for new ones if there are no events yet (long
+    polling). If the requested events have been already pushed out of the
+    buffer, the client gets the "reset" flag and should reload alarm states.
+    """
+
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.events = collections.deque(maxlen=1000)
+        self.seq = 0
+        self.published = 0
+        self.polls = 0
+        self.waiting = 0
+
+    def resize(self, size):
+        with self.cv:
+            self.events = collections.deque(self.events, maxlen=size)
+
+    def publish(self,
+                alarm_id,
+                action,
+                level,
+                description,
+                u='',
+                utp='',
+                key_id='',
+                t=None):
+        with self.cv:
+            self.seq += 1
+            self.events.append({
+                'seq': self.seq,
+                'alarm_id': alarm_id,
+                'action': action,
+                'level': level,
+                'description': description,
+                'u': u,
+                'utp': utp,
+                'key_id': key_id,
+                't': t if t is not None else time.time()
+            })
+            self.published += 1
+            self.cv.notify_all()
+
+    def get(self, seq, n, timeout, filter_func):
+        """
+        Returns events after seq, accepted by filter_func, waits for new
+        events up to timeout seconds
+
+        Returns tuple (events, last seq, reset flag)
+        """
+        deadline = time.monotonic() + timeout
+        reset = False
+        result = []
+        with self.cv:
+            self.polls += 1
+            if seq is None:
+                seq = self.seq
+            elif seq > self.seq:
+                # the controller has been restarted
+                reset = True
+                seq = self.seq
+        while True:
+            with self.cv:
+                first = self.events[0]['seq'] if self.events else self.seq + 1
+                if seq + 1 < first:
+                    reset = True
+                    seq = first - 1
+                events = list(
+                    itertools.islice(self.events, seq - first + 1, None))
+            for ev in events:
+                seq = ev['seq']
+                # events are checked outside of the lock, so publishers are
+                # not blocked by ACL checks
+                if filter_func(ev):
+                    result.append(ev)
+                    if len(result) >= n:
+                        break
+            if result or reset:
+                break
+            with self.cv:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self.seq == seq:
+                    self.waiting += 1
+                    try:
+                        self.cv.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+        return result, seq, reset
+
+    def serialize(self):
+        return {
+            'seq': self.seq,
+            'buffered': len(self.events),
+            'published': self.published,
+            'polls': self.polls,
+            'waiting': self.waiting
+        }
+
+
+event_bus = EventBus()
+
+
+class TriggerGate:
+    """
+    Per-alarm trigger gate
+
+    Repeated triggers of an alarm with the same or lower level, which occur
+    within trigger_window seconds after the logged one, are coalesced: they
+    are not processed at all, the hit counter of the logged record is
+    increased instead. Triggers with higher level (escalations) and triggers
+    after the alarm has been acknowledged always pass.
+
+    Notifications of the same or lower level are not sent more often than
+    once per notify_min_interval seconds (hold-down after ack for flapping
+    alarms).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # alarm_id -> [logged level, log record time, notified level,
+        #   notification time]
+        self.alarms = {}
+        self.coalesced = 0
+        self.suppressed = 0
+
+    def coalesce(self, alarm_id, level):
+        """
+        Returns time of the logged record if the trigger should be coalesced,
+        otherwise None
+        """
+        if not flags.trigger_window:
+            return None
+        st = self.alarms.get(alarm_id)
+        if st and st[0] >= level and \
+                time.time() - st[1] < flags.trigger_window:
+            cur_level = state_cache.get_level(alarm_id)
+            if cur_level is not None and cur_level >= level:
+                with self.lock:
+                    self.coalesced += 1
+                return st[1]
+        return None
+
+    def logged(self, alarm_id, level, t):
+        with self.lock:
+            st = self.alarms.setdefault(alarm_id, [0, 0, 0, 0])
+            st[0] = level
+            st[1] = t
+
+    def may_notify(self, alarm_id, level):
+        now = time.time()
+        with self.lock:
+            st = self.alarms.setdefault(alarm_id, [0, 0, 0, 0])
+            if flags.notify_min_interval and st[2] >= level and \
+                    now - st[3] < flags.notify_min_interval:
+                self.suppressed += 1
+                return False
+            st[2] = level
+            st[3] = now
+            return True
+
+    def serialize(self):
+        return {
+            'alarms': len(self.alarms),
+            'coalesced': self.coalesced,
+            'suppressed': self.suppressed
+        }
+
+
+trigger_gate = TriggerGate()
+
+
+class BatchWriter:
+    """
+    Buffers database records and writes them in batches
+
+    Buffered records are flushed in a single transaction when batch_size
+    records are collected or every flush_interval seconds. Until the writer is
+    started (and after it is stopped), records are written immediately.
+
+    Subclasses implement _write(db, records, *extra) and may override _take()
+    to collect extra buffered data and _written(db, records, *extra) to
+    process the data after the transaction is committed. If the batch can
+    not be written, records are written one by one, so only bad ones are lost
+    """
+
+    name = 'alarmer_batch_writer'
+    title = 'record(s)'
+    # writer label for metrics
+    label = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.cv = threading.Condition(self.lock)
+        self.buf = []
+        self.thread = None
+        self.active = False
+        self.batch_size = 1
+        self.flush_interval = 1
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self.flush_time_last = 0
+        self.flush_time_max = 0
+        self.flush_time_total = 0
+
+    def start(self, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.active = True
+        self.thread = threading.Thread(target=self._run,
+                                       name=self.name,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cv:
+            self.active = False
+            self.cv.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def append(self, **record):
+        with self.cv:
+            self.buf.append(record)
+            if self.active:
+                if len(self.buf) >= self.batch_size:
+                    self.cv.notify()
+                return
+        self.flush()
+
+    def _take(self):
+        """
+        Takes buffered data, called with the lock acquired
+        """
+        records = self.buf
+        self.buf = []
+        return (records,)
+
+    def _write(self, db, records):
+        raise NotImplementedError
+
+    def _written(self, db, *batch):
+        pass
+
+    @staticmethod
+    def _split(records, *extra):
+        """
+        Splits the batch into single-record batches, extra data goes
+        separately
+        """
+        for record in records:
+            yield ([record], *(type(x)() for x in extra))
+        if any(extra):
+            yield ([], *extra)
+
+    def _commit(self, *batch):
+        db = get_db()
+        with db.begin():
+            self._write(db, *batch)
+        self.written += len(batch[0])
+        try:
+            self._written(db, *batch)
+        except:
+            pa.log_traceback()
+            reset_db()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch = self._take()
+            if not any(batch):
+                return
+            t_start = time.perf_counter()
+            try:
+                self._commit(*batch)
+            except:
+                logger.warning(f'Unable to insert {len(batch[0])} '
+                               f'{self.title} in batch, writing one by one')
+                reset_db()
+                # write records one by one, so only bad ones are lost
+                for b in self._split(*batch):
+                    try:
+                        self._commit(*b)
+                    except:
+                        self.failed += len(b[0])
+                        logger.error(
+                            f'Unable to insert {len(b[0])} {self.title}')
+                        pa.log_traceback()
+                        reset_db()
+            t = time.perf_counter() - t_start
+            metrics.observe('alarmer_db_write_seconds', t, writer=self.label)
+            self.flushes += 1
+            self.flush_time_last = t
+            self.flush_time_total += t
+            if t > self.flush_time_max:
+                self.flush_time_max = t
+
+    def _run(self):
+        while True:
+            with self.cv:
+                if self.active and len(self.buf) < self.batch_size:
+                    self.cv.wait(timeout=self.flush_interval)
+                if not self.active:
+                    break
+            self.flush()
+
+    def serialize(self):
+        return {
+            'queue': len(self.buf),
+            'written': self.written,
+            'failed': self.failed,
+            'flushes': self.flushes,
+            'flush_time_last': self.flush_time_last,
+            'flush_time_max': self.flush_time_max,
+            'flush_time_avg': self.flush_time_total /
+                              self.flushes if self.flushes else 0
+        }
+
+
+class LogWriter(BatchWriter):
+    """
+    Buffers alarm log records and writes them in batches of log_batch_size
+    records or every log_flush_interval ms
+    """
+
+    name = 'alarmer_log_writer'
+    title = 'alarm log record(s)'
+    label = 'log'
+
+    def __init__(self):
+        super().__init__()
+        self.hits = {}
+
+    def add_hit(self, alarm_id, t):
+        """
+        Increases hit counter of the trigger record
+        """
+        with self.cv:
+            key = (alarm_id, t)
+            self.hits[key] = self.hits.get(key, 0) + 1
+            if self.active:
+                return
+        self.flush()
+
+    def _take(self):
+        records = self.buf
+        self.buf = []
+        hits = self.hits
+        self.hits = {}
+        return records, hits
+
+    def _write(self, db, records, hits):
+        if records:
+            db.execute(
+                sql('insert into alarmer_log'
+                    '(u, utp, key_id, alarm_id, description, '
+                    'action, t, level) '
+                    'values (:u, :utp, :key_id, :alarm_id, '
+                    ':description, :action, :t, :level)'), records)
+        if hits:
+            db.execute(
+                sql('update alarmer_log set hits=hits+:n '
+                    'where alarm_id=:alarm_id and t=:t '
+                    "and action='T'"), [{
+                        'alarm_id': k[0],
+                        't': k[1],
+                        'n': v
+                    } for k, v in hits.items()])
+
+    def _written(self, db, records, hits):
+        # rollups are updated in own transaction, so their failure does not
+        # affect the log
+        stats_rollup.update(db, records, hits)
+
+
+class StatsRollup:
+    """
+    Alarm statistics rollups
+
+    Trigger, acknowledgement and coalesced hit counters and total
+    acknowledgement time (trigger -> ack) are kept in alarmer_stats table per
+    alarm for hourly and daily (UTC) periods. The rollups are updated by the
+    log writer after each flush and are not affected by the log retention.
+    """
+
+    fields = ('triggers', 'warnings', 'alarms', 'acks', 'hits', 'ack_count',
+              'ack_time')
+
+    def __init__(self):
+        self.updates = 0
+        self.failed = 0
+
+    @staticmethod
+    def _get_trigger_time(db, alarm_id, t):
+        """
+        Returns time of the first trigger after the previous ack
+        """
+        r = db.execute(sql(
+            "select min(t) from alarmer_log where alarm_id=:i and action='T' "
+            'and t<=:t and t>coalesce((select max(t) from alarmer_log '
+            "where alarm_id=:i and action='A' and t<:t), 0)"),
+                       i=alarm_id,
+                       t=t).fetchone()
+        return r[0] if r else None
+
+    def update(self, db, records, hits):
+        deltas = {}
+
+        def get_deltas(alarm_id, t):
+            return [
+                deltas.setdefault((alarm_id, period, int(t - t % period)),
+                                  dict.fromkeys(self.fields, 0))
+                for period in STATS_PERIODS
+            ]
+
+        try:
+            for r in records:
+                if r['action'] == 'T':
+                    f = 'warnings' if r['level'] == 1 else 'alarms'
+                    for d in get_deltas(r['alarm_id'], r['t']):
+                        d['triggers'] += 1
+                        d[f] += 1
+                elif r['action'] == 'A':
+                    t_trigger = self._get_trigger_time(db, r['alarm_id'],
+                                                       r['t'])
+                    for d in get_deltas(r['alarm_id'], r['t']):
+                        d['acks'] += 1
+                        if t_trigger is not None:
+                            d['ack_count'] += 1
+                            d['ack_time'] += r['t'] - t_trigger
+            for (alarm_id, t), n in hits.items():
+                for d in get_deltas(alarm_id, t):
+                    d['hits'] += n
+            with db.begin():
+                for (alarm_id, period, t), d in deltas.items():
+                    kw = dict(d, alarm_id=alarm_id, period=period, t=t)
+                    if not db.execute(
+                            sql('update alarmer_stats set '
+                                'triggers=triggers+:triggers, '
+                                'warnings=warnings+:warnings, '
+                                'alarms=alarms+:alarms, acks=acks+:acks, '
+                                'hits=hits+:hits, '
+                                'ack_count=ack_count+:ack_count, '
+                                'ack_time=ack_time+:ack_time '
+                                'where alarm_id=:alarm_id and period=:period '
+                                'and t=:t'), **kw).rowcount:
+                        db.execute(
+                            sql('insert into alarmer_stats(alarm_id, grp, '
+                                'period, t, triggers, warnings, alarms, acks, '
+                                'hits, ack_count, ack_time) values '
+                                '(:alarm_id, :grp, :period, :t, :triggers, '
+                                ':warnings, :alarms, :acks, :hits, '
+                                ':ack_count, :ack_time)'),
+                            grp=alarm_id.rsplit('/', 1)[0]
+                            if '/' in alarm_id else '',
+                            **kw)
+            self.updates += len(deltas)
+        except:
+            self.failed += 1
+            logger.error('Unable to update alarm statistics rollups')
+            raise
+
+    @staticmethod
+    def clean(db, now):
+        """
+        Deletes expired rollups
+        """
+        purged = 0
+        for period, keep in ((3600, flags.keep_stats_hourly),
+                             (86400, flags.keep_stats_daily)):
+            if keep:
+                purged += db.execute(
+                    sql('delete from alarmer_stats where period=:period '
+                        'and t<:t'),
+                    period=period,
+                    t=now - keep).rowcount
+        return purged
+
+    def serialize(self):
+        return {'updates': self.updates, 'failed': self.failed}
+
+
+stats_rollup = StatsRollup()
+
+
+log_writer = LogWriter()
+
+
+def unique_emails(emails):
+    result = []
+    seen = set()
+    for email in emails:
+        if email:
+            email = email.strip()
+            if email and email.lower() not in seen:
+                seen.add(email.lower())
+                result.append(email)
+    return result
+
+
+def get_recipients(alarm_id, level, levels=None):
+    """
+    Returns deduplicated list of email addresses of users, subscribed to the
+    alarm at the specified or lower level (and at one of levels, if specified)
+    """
+    return sub_index.get_recipients(alarm_id, level, levels)
+
+
+def compile_alarm_mask(mask):
+    """
+    Compiles alarm id mask to regular expression
+
+    Mask segments are separated with "/". "+" matches any single segment,
+    "#" (the last segment only) matches one or more segments, other segments
+    may contain "*" wildcards, e.g. "boilers/#", "+/temp*", "#"
+    """
+    parts = mask.strip('/').split('/')
+    rx = []
+    for n, p in enumerate(parts):
+        if p == '#':
+            if n != len(parts) - 1:
+                raise ValueError('"#" must be the last mask segment')
+            rx.append('.+')
+        elif p == '+':
+            rx.append('[^/]+')
+        elif p:
+            rx.append(re.escape(p).replace('\\*', '[^/]*'))
+        else:
+            raise ValueError(f'invalid mask: {mask}')
+    return re.compile('/'.join(rx))
+
+
+class SubscriptionIndex:
+    """
+    In-memory subscription index
+
+    alarm_id -> list of (level, u, utp, email), sorted by level
+
+    Direct subscriptions (alarmer_sub) are merged with subscription rules
+    (alarmer_sub_rule), which subscribe a user or all members of a team
+    (userinfo_team_field) to all alarms, matching the id mask. Rules are
+    expanded for all known alarms when the index is loaded and for other
+    alarms on the first lookup, so getting recipients is always a single dict
+    lookup. If a user is subscribed to the alarm both directly and by rules,
+    the lowest level is used.
+
+    The index is loaded at startup, updated write-through by subscription API
+    methods and periodically reconciled with the database to pick up changes
+    made by other nodes (e.g. subscriptions created via SFA) and userinfo
+    email and team changes. Lists are never modified in place, so readers do
+    not need to acquire the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        # alarm_id -> list of (level, u, utp, email)
+        self.direct = {}
+        # list of (compiled mask, level, list of (u, utp, email))
+        self.rules = []
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.expanded = 0
+
+    def load(self):
+        db = get_db()
+        emails = {}
+        for d in db.execute(sql('select u, utp, value from userinfo '
+                                'where name=:name'),
+                            name=flags.userinfo_email_field):
+            emails[(d.u, d.utp)] = d.value
+        teams = {}
+        for d in db.execute(sql('select u, utp, value from userinfo '
+                                'where name=:name'),
+                            name=flags.userinfo_team_field):
+            for team in (d.value or '').split(','):
+                team = team.strip()
+                if team:
+                    teams.setdefault(team, []).append(
+                        (d.u, d.utp, emails.get((d.u, d.utp))))
+        direct = {}
+        for d in db.execute(
+                sql('select alarm_id, level, u, utp from alarmer_sub')):
+            direct.setdefault(d.alarm_id, []).append(
+                (d.level, d.u, d.utp, emails.get((d.u, d.utp))))
+        rules = []
+        for d in db.execute(
+                sql('select mask, level, u, utp, team from alarmer_sub_rule')):
+            try:
+                mask = compile_alarm_mask(d.mask)
+            except ValueError as e:
+                logger.warning(f'alarmer subscription rule ignored: {e}')
+                continue
+            if d.team:
+                members = teams.get(d.team, [])
             else:
-                pa.api_call('set', i=f'lvar:alarmer/{alarm_id}', v=level)
-                logger.warning('Alarm triggered: '
-                               f'{alarm_id}, level: {get_level_name(level)}')
-                r = db.execute(sql('select u, utp from alarmer_sub '
-                                   'where alarm_id=:i and level<=:level'),
-                               i=alarm_id,
-                               level=level)
-                recip = []
-                subject = f'{get_level_name(level)}: {lv["description"]}'
-                text = (f'{get_level_name(level)}: {lv["description"]} '
-                        f'({alarm_id})\n'
-                        f'System: {eva.core.config.system_name}')
-                sendmail = partial(eva.mailer.send, subject=subject, text=text)
-                while True:
-                    ui = r.fetchone()
-                    if ui:
-                        r2 = db.execute(sql('select value from userinfo where '
-                                            'name=:name and u=:u and utp=:utp'),
-                                        name=flags.userinfo_email_field,
-                                        u=ui.u,
-                                        utp=ui.utp)
-                        while True:
-                            d = r2.fetchone()
-                            if d:
-                                logger.debug(
-                                    f'sending alarm email to {d.value}')
-                                sendmail(rcp=recip)
-                            else:
-                                break
+                members = [(d.u, d.utp, emails.get((d.u, d.utp)))]
+            rules.append((mask, d.level, members))
+        alarm_ids = set(direct)
+        if rules:
+            alarm_ids.update(state_cache.states)
+            if registry.alarms:
+                alarm_ids.update(registry.alarms)
+        index = {}
+        for alarm_id in alarm_ids:
+            entries = self._merge(alarm_id, direct.get(alarm_id, ()), rules)
+            if entries:
+                index[alarm_id] = entries
+        with self.lock:
+            self.index = index
+            self.direct = direct
+            self.rules = rules
+            self.reloads += 1
+        logger.debug(f'alarmer subscription index loaded, {len(index)} alarms, '
+                     f'{len(rules)} rules')
+
+    @staticmethod
+    def _merge(alarm_id, direct, rules):
+        subs = {}
+        for level, u, utp, email in direct:
+            subs[(u, utp)] = (level, email)
+        for mask, level, members in rules:
+            if mask.fullmatch(alarm_id):
+                for u, utp, email in members:
+                    s = subs.get((u, utp))
+                    if s is None or level < s[0]:
+                        subs[(u, utp)] = (level, email)
+        entries = [(v[0], k[0], k[1], v[1]) for k, v in subs.items()]
+        entries.sort(key=lambda x: x[:3])
+        return entries
+
+    def _get(self, index, alarm_id):
+        try:
+            return index[alarm_id]
+        except KeyError:
+            rules = self.rules
+            if not rules:
+                return ()
+        # expand rules for the alarm, not indexed yet, and cache the result
+        # (empty as well) until the next index reload
+        entries = self._merge(alarm_id, (), rules)
+        with self.lock:
+            if self.index is index and alarm_id not in index:
+                index[alarm_id] = entries
+                self.expanded += 1
+        return entries
+
+    def get_recipients(self, alarm_id, level, levels=None):
+        index = self.index
+        if index is None:
+            with self.lock:
+                self.misses += 1
+            return self._get_recipients_db(alarm_id, level, levels)
+        with self.lock:
+            self.hits += 1
+        emails = []
+        for e in self._get(index, alarm_id):
+            if e[0] > level:
+                break
+            if levels is None or e[0] in levels:
+                emails.append(e[3])
+        return unique_emails(emails)
+
+    def has_subscribers(self, alarm_id, level, levels=None):
+        """
+        Returns False only if the index is loaded and there are no matching
+        subscriptions
+        """
+        index = self.index
+        if index is None:
+            return True
+        for e in self._get(index, alarm_id):
+            if e[0] > level:
+                break
+            if levels is None or e[0] in levels:
+                return True
+        return False
+
+    @staticmethod
+    def _get_recipients_db(alarm_id, level, levels=None):
+        # subscription rules are not used, as they require the index
+        r = get_db().execute(sql(
+            'select alarmer_sub.level, userinfo.value as email '
+            'from alarmer_sub '
+            'join userinfo on userinfo.u=alarmer_sub.u '
+            'and userinfo.utp=alarmer_sub.utp and userinfo.name=:name '
+            'where alarmer_sub.alarm_id=:i and alarmer_sub.level<=:level'),
+                             name=flags.userinfo_email_field,
+                             i=alarm_id,
+                             level=level)
+        return unique_emails(
+            [d.email for d in r if levels is None or d.level in levels])
+
+    def get_subscribers(self, alarm_id):
+        index = self.index
+        return self._get(index, alarm_id) if index else []
+
+    def _update(self, alarm_id, direct):
+        # must be called with the lock acquired
+        if direct:
+            self.direct[alarm_id] = direct
+        else:
+            self.direct.pop(alarm_id, None)
+        entries = self._merge(alarm_id, direct, self.rules)
+        if entries or self.rules:
+            self.index[alarm_id] = entries
+        else:
+            self.index.pop(alarm_id, None)
+
+    def subscribe(self, alarm_id, u, utp, level, email):
+        with self.lock:
+            if self.index is not None:
+                direct = [
+                    e for e in self.direct.get(alarm_id, ())
+                    if e[1] != u or e[2] != utp
+                ]
+                direct.append((level, u, utp, email))
+                self._update(alarm_id, direct)
+
+    def unsubscribe(self, alarm_id, u, utp):
+        with self.lock:
+            if self.index is not None:
+                self._update(alarm_id, [
+                    e for e in self.direct.get(alarm_id, ())
+                    if e[1] != u or e[2] != utp
+                ])
+
+    def drop(self, alarm_id):
+        with self.lock:
+            if self.index is not None:
+                self.index.pop(alarm_id, None)
+                self.direct.pop(alarm_id, None)
+
+    def serialize(self):
+        index = self.index
+        return {
+            'loaded': index is not None,
+            'alarms': len(index) if index else 0,
+            'rules': len(self.rules),
+            'hits': self.hits,
+            'misses': self.misses,
+            'reloads': self.reloads,
+            'expanded': self.expanded
+        }
+
+
+sub_index = SubscriptionIndex()
+
+
+def send_mail(subject, text, recip):
+    sendmail = partial(eva.mailer.send, subject=subject, text=text)
+    bs = flags.notify_batch_size if flags.notify_batch_size else len(recip)
+    for n in range(0, len(recip), bs):
+        batch = recip[n:n + bs]
+        logger.debug(f'sending alarm email to {", ".join(batch)}')
+        timer = metrics.timer('alarmer_mail')
+        sendmail(rcp=batch)
+        timer.done()
+
+
+class DigestBuffer:
+    """
+    Collects alarm notifications per recipient for digest_window seconds
+
+    When the window is over, all notifications, collected for the recipient,
+    are sent as a single email. Recipients with the same list of alarms get
+    the same email.
+
+    If the spool is enabled, notification jobs are kept in the spool until
+    digests to all their recipients are sent. If any of the digests fails,
+    the job is retried for all its recipients.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # recipient -> (window start time, list of jobs)
+        self.pending = {}
+        self.digests = 0
+
+    def add(self, recip, job):
+        now = time.time()
+        with self.lock:
+            # recipients the job is not sent to yet
+            job.digest_pending = len(recip)
+            job.digest_failed = False
+            for r in recip:
+                try:
+                    self.pending[r][1].append(job)
+                except KeyError:
+                    self.pending[r] = (now, [job])
+
+    def flush(self, force=False):
+        now = time.time()
+        with self.lock:
+            expired = [
+                r for r, v in self.pending.items()
+                if force or now - v[0] >= flags.digest_window
+            ]
+            groups = {}
+            for r in expired:
+                jobs = self.pending.pop(r)[1]
+                groups.setdefault(tuple(id(j) for j in jobs),
+                                  (jobs, []))[1].append(r)
+        for jobs, recip in groups.values():
+            try:
+                self.send(jobs, recip)
+                failed = False
+            except:
+                logger.error('Unable to send alarm digest to '
+                             f'{", ".join(recip)}')
+                pa.log_traceback()
+                failed = True
+            completed = []
+            with self.lock:
+                for job in jobs:
+                    job.digest_pending -= len(recip)
+                    if failed:
+                        job.digest_failed = True
+                    if job.digest_pending <= 0:
+                        completed.append(job)
+            if flags.spool:
+                for job in completed:
+                    if job.digest_failed:
+                        spool.retry(job)
                     else:
+                        spool.done(job)
+
+    def send(self, jobs, recip):
+        level = max(j.level for j in jobs)
+        subject = (f'{get_level_name(level)}: {len(jobs)} '
+                   f'alarm{"s" if len(jobs) > 1 else ""} triggered')
+        lines = [
+            f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(j.t))} '
+            f'{get_level_name(j.level)}: {j.description} ({j.alarm_id})'
+            for j in jobs[:DIGEST_MAX_ALARMS]
+        ]
+        if len(jobs) > DIGEST_MAX_ALARMS:
+            lines.append(f'... and {len(jobs) - DIGEST_MAX_ALARMS} more')
+        lines.append(f'System: {eva.core.config.system_name}')
+        send_mail(subject, '\n'.join(lines), recip)
+        with self.lock:
+            self.digests += 1
+
+    def serialize(self):
+        return {'recipients': len(self.pending), 'sent': self.digests}
+
+
+digest = DigestBuffer()
+
+
+class NotificationDispatcher:
+    """
+    Delivers alarm notifications of the channel outside of the LM PLC macro
+    thread
+
+    Jobs are put into a bounded queue, which is drained by a pool of sender
+    workers. If the queue is full, the job is handled according to the
+    overflow policy:
+
+        - block: wait up to notify_queue_timeout seconds, then drop the job
+        - drop: drop the new job
+        - drop_oldest: drop the oldest queued job to make room for the new one
+
+    If the notification spool is enabled, dropped jobs stay in the spool and
+    are queued again by the spool retrier.
+
+    If the pool size is zero, notifications are delivered inline
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.q = None
+        self.workers = []
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        self.q = queue.Queue(maxsize=self.channel.queue_size)
+        for n in range(self.channel.workers):
+            t = threading.Thread(target=self._run,
+                                 name=f'alarmer_{self.channel.name}_{n}',
+                                 daemon=True)
+            t.start()
+            self.workers.append(t)
+
+    def stop(self):
+        # queued jobs are delivered before workers exit
+        for _ in self.workers:
+            try:
+                self.q.put(None, timeout=flags.notify_stop_timeout)
+            except queue.Full:
+                break
+        for t in self.workers:
+            t.join(timeout=flags.notify_stop_timeout)
+        self.workers.clear()
+        if self.q and self.q.qsize():
+            if flags.spool:
+                logger.warning(f'{self.q.qsize()} alarm notification(s) '
+                               f'left in spool on stop: {self.channel.name}')
+            else:
+                logger.error(f'{self.q.qsize()} alarm notification(s) '
+                             f'not delivered on stop: {self.channel.name}')
+
+    def qsize(self):
+        return self.q.qsize() if self.q else 0
+
+    def free_slots(self):
+        if not self.workers or not self.q.maxsize:
+            return SPOOL_REQUEUE_MAX
+        return self.q.maxsize - self.q.qsize()
+
+    def serialize(self):
+        return {
+            'queue': self.qsize(),
+            'workers': len(self.workers),
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped
+        }
+
+    def put(self, job):
+        if flags.spool:
+            spool.put(job)
+        if not self.workers:
+            self.deliver(job)
+            return
+        try:
+            if flags.notify_queue_overflow == 'block':
+                self.q.put(job, timeout=flags.notify_queue_timeout)
+            else:
+                self.q.put_nowait(job)
+            return
+        except queue.Full:
+            pass
+        if flags.notify_queue_overflow == 'drop_oldest':
+            try:
+                old = self.q.get_nowait()
+                self.q.task_done()
+                if old is not None:
+                    self._drop(old)
+                self.q.put_nowait(job)
+                return
+            except (queue.Empty, queue.Full):
+                pass
+        self._drop(job)
+
+    def offer(self, job):
+        """
+        Puts the job into the queue only if there is a free slot
+        """
+        if not self.workers:
+            self.deliver(job)
+            return True
+        try:
+            self.q.put_nowait(job)
+            return True
+        except queue.Full:
+            return False
+
+    def _drop(self, job):
+        with self.lock:
+            self.dropped += 1
+        if flags.spool:
+            spool.release(job)
+            logger.error(f'Notification queue {self.channel.name} is full, '
+                         f'notifications for alarm are deferred: '
+                         f'{job.alarm_id}')
+        else:
+            logger.error(f'Notification queue {self.channel.name} is full, '
+                         f'dropping notifications for alarm: {job.alarm_id}')
+
+    def deliver(self, job):
+        try:
+            if flags.spool:
+                # make sure the job is written into the spool before sending
+                spool.flush()
+            deferred = self.channel.deliver(job)
+            with self.lock:
+                self.sent += 1
+        except:
+            with self.lock:
+                self.failed += 1
+            logger.error(f'Unable to send {self.channel.name} notifications '
+                         f'for alarm: {job.alarm_id}')
+            pa.log_traceback()
+            if flags.spool:
+                spool.retry(job)
+            return
+        if flags.spool and not deferred:
+            spool.done(job)
+
+    def _run(self):
+        while True:
+            job = self.q.get()
+            try:
+                if job is None:
+                    break
+                self.deliver(job)
+            finally:
+                self.q.task_done()
+
+
+class NotificationSpool(BatchWriter):
+    """
+    Persistent queue of alarm notifications
+
+    Notification jobs are written into alarmer_spool table (in batches, before
+    being sent) and deleted after delivery, so queued and failed jobs survive
+    controller restarts. Failed jobs are retried with exponential backoff by
+    the spool retrier, which also replays the jobs left in the spool at
+    startup.
+
+    Each job has an idempotency key, built from channel name, alarm id, level
+    and trigger time. Jobs, which are queued or being delivered, are tracked
+    by their keys and never queued twice.
+    """
+
+    name = 'alarmer_spool_writer'
+    title = 'notification spool record(s)'
+    label = 'spool'
+
+    def __init__(self):
+        super().__init__()
+        # keys of jobs, which are queued or being delivered
+        self.inflight = set()
+        self.inflight_lock = threading.Lock()
+        self.delivered = 0
+        self.retries = 0
+        self.requeued = 0
+        self.expired = 0
+
+    def _write(self, db, records):
+        db.execute(
+            sql('insert into alarmer_spool'
+                '(ikey, channel, alarm_id, level, description, t, attempts, '
+                'next_t) values (:ikey, :channel, :alarm_id, :level, '
+                ':description, :t, :attempts, :next_t)'), records)
+
+    def put(self, job):
+        job.key = get_notification_key(job)
+        job.attempts = 0
+        with self.inflight_lock:
+            self.inflight.add(job.key)
+        self.append(ikey=job.key,
+                    channel=job.channel,
+                    alarm_id=job.alarm_id,
+                    level=job.level,
+                    description=job.description,
+                    t=job.t,
+                    attempts=0,
+                    next_t=job.t)
+
+    def release(self, job):
+        """
+        Releases the job, which is not queued anymore, but stays in the spool
+        """
+        with self.inflight_lock:
+            self.inflight.discard(job.key)
+
+    def done(self, job):
+        try:
+            get_db().execute(sql('delete from alarmer_spool where ikey=:ikey'),
+                             ikey=job.key)
+            with self.inflight_lock:
+                self.delivered += 1
+        except:
+            logger.error('Unable to delete delivered notification job '
+                         f'from spool: {job.alarm_id}')
+            pa.log_traceback()
+            reset_db()
+        finally:
+            self.release(job)
+
+    def retry(self, job):
+        job.attempts += 1
+        try:
+            db = get_db()
+            if flags.spool_max_attempts and \
+                    job.attempts >= flags.spool_max_attempts:
+                logger.error(f'Giving up notifications for alarm '
+                             f'{job.alarm_id} after {job.attempts} attempts')
+                db.execute(sql('delete from alarmer_spool where ikey=:ikey'),
+                           ikey=job.key)
+                with self.inflight_lock:
+                    self.expired += 1
+            else:
+                delay = min(flags.spool_backoff * 2**(job.attempts - 1),
+                            flags.spool_backoff_max)
+                db.execute(sql('update alarmer_spool set attempts=:attempts, '
+                               'next_t=:next_t where ikey=:ikey'),
+                           attempts=job.attempts,
+                           next_t=time.time() + delay,
+                           ikey=job.key)
+                with self.inflight_lock:
+                    self.retries += 1
+        except:
+            logger.error('Unable to update notification job in spool: '
+                         f'{job.alarm_id}')
+            pa.log_traceback()
+            reset_db()
+        finally:
+            self.release(job)
+
+    def requeue(self):
+        """
+        Puts due jobs from the spool into the notification queues
+        """
+        for channel in channels.values():
+            self._requeue(channel)
+
+    def _requeue(self, channel):
+        dispatcher = channel.dispatcher
+        limit = min(dispatcher.free_slots(), SPOOL_REQUEUE_MAX)
+        if limit <= 0:
+            return
+        jobs = []
+        # the lock is held while selecting, so jobs, completed meanwhile, are
+        # either not selected or still marked as inflight
+        with self.inflight_lock:
+            for r in get_db().execute(
+                    sql('select ikey, alarm_id, level, description, t, '
+                        'attempts from alarmer_spool where channel=:channel '
+                        'and next_t<=:t order by next_t limit :n'),
+                    channel=channel.name,
+                    t=time.time(),
+                    n=limit + len(self.inflight)):
+                if r.ikey not in self.inflight:
+                    self.inflight.add(r.ikey)
+                    jobs.append(
+                        SimpleNamespace(channel=channel.name,
+                                        alarm_id=r.alarm_id,
+                                        level=r.level,
+                                        description=r.description,
+                                        t=r.t,
+                                        key=r.ikey,
+                                        attempts=r.attempts))
+                    if len(jobs) >= limit:
                         break
+        for n, job in enumerate(jobs):
+            if not dispatcher.offer(job):
+                for j in jobs[n:]:
+                    self.release(j)
+                break
+            with self.inflight_lock:
+                self.requeued += 1
+
+    def pending(self):
+        return get_db().execute(
+            sql('select count(*) from alarmer_spool')).fetchone()[0]
+
+    def purge_channels(self):
+        """
+        Deletes jobs of the channels, which are not configured anymore
+        """
+        r = get_db().execute(
+            sql('delete from alarmer_spool where channel not in :channels').
+            bindparams(sa.bindparam('channels', expanding=True)),
+            channels=list(channels))
+        if r.rowcount:
+            logger.warning(f'{r.rowcount} alarm notification(s) of removed '
+                           'channels deleted from spool')
+
+    def serialize(self):
+        result = super().serialize()
+        result.update({
+            'inflight': len(self.inflight),
+            'delivered': self.delivered,
+            'retries': self.retries,
+            'requeued': self.requeued,
+            'expired': self.expired
+        })
+        return result
+
+
+spool = NotificationSpool()
+
+
+def dispatch(job):
+    """
+    Puts the notification job into queues of the channels, which serve
+    subscriptions of the job level
+    """
+    for channel in channels.values():
+        if channel.min_level <= job.level and sub_index.has_subscribers(
+                job.alarm_id, job.level, channel.levels):
+            channel.dispatcher.put(SimpleNamespace(channel=channel.name,
+                                                   **vars(job)))
+
+
+def get_notification_key(job):
+    """
+    Returns idempotency key of the notification job, the same for all
+    delivery attempts
+    """
+    return hashlib.sha1(
+        f'{job.channel}\0{job.alarm_id}\0{job.level}\0{job.t!r}'.encode(
+        )).hexdigest()
+
+
+def get_notification_payload(job, recip):
+    return {
+        # receivers use the key to skip duplicates, delivered again after
+        # a crash
+        'key': get_notification_key(job),
+        'alarm_id': job.alarm_id,
+        'level': job.level,
+        'level_name': get_level_name(job.level),
+        'description': job.description,
+        't': job.t,
+        'system': eva.core.config.system_name,
+        'recipients': recip
+    }
+
+
+class NotificationChannel:
+    """
+    Base notification channel
+
+    The channel delivers notifications to users, subscribed at the specified
+    levels. Each channel has own sender pool, queue and timeout, so slow
+    channels do not delay others.
+    """
+
+    type = None
+
+    def __init__(self, name, config):
+        self.name = name
+        self.levels = {
+            int(x) for x in str(config.get('levels', '1,2')).split(',')
+        }
+        if not self.levels or self.levels - {1, 2}:
+            raise ValueError(f'channel {name}: levels should be 1 and/or 2')
+        self.min_level = min(self.levels)
+        self.workers = int(config.get('workers', flags.notify_workers))
+        self.queue_size = int(config.get('queue_size',
+                                         flags.notify_queue_size))
+        self.timeout = float(config.get('timeout', 30))
+        self.dispatcher = NotificationDispatcher(self)
+
+    def deliver(self, job):
+        timer = metrics.timer('alarmer_delivery', channel=self.name)
+        try:
+            recip = get_recipients(job.alarm_id, job.level, self.levels)
+            timer.phase('recipients')
+            if not recip:
+                logger.debug(f'no {self.name} subscribers for alarm: '
+                             f'{job.alarm_id}')
+                return
+            deferred = self.send(job, recip)
+            timer.phase('send')
+            return deferred
+        finally:
+            timer.done()
+
+    def send(self, job, recip):
+        """
+        Sends the notification, returns True if the delivery is deferred (the
+        job is completed in the spool later)
+        """
+        raise NotImplementedError
+
+    def serialize(self):
+        result = self.dispatcher.serialize()
+        result.update({'type': self.type, 'levels': sorted(self.levels)})
+        return result
+
+
+class EmailChannel(NotificationChannel):
+    """
+    Sends notifications with LM PLC mailer, the timeout is set in mailer
+    configuration
+    """
+
+    type = 'email'
+
+    def send(self, job, recip):
+        if flags.digest_window and (not flags.digest_bypass_level or
+                                    job.level < flags.digest_bypass_level):
+            digest.add(recip, job)
+            return True
+        subject = f'{get_level_name(job.level)}: {job.description}'
+        text = (f'{get_level_name(job.level)}: {job.description} '
+                f'({job.alarm_id})\n'
+                f'System: {eva.core.config.system_name}')
+        send_mail(subject, text, recip)
+
+
+class WebhookChannel(NotificationChannel):
+    """
+    Posts notifications as JSON to HTTP(S) URL
+
+    Each sender worker keeps own keep-alive connection
+    """
+
+    type = 'webhook'
+
+    def __init__(self, name, config):
+        super().__init__(name, config)
+        import http.client
+        import urllib.parse
+        try:
+            url = urllib.parse.urlsplit(config['url'])
+        except KeyError:
+            raise ValueError(f'channel {name}: url is not specified')
+        if url.scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+        elif url.scheme == 'http':
+            self.connection_class = http.client.HTTPConnection
         else:
-            logger.debug(f'Inactive alarm triggered: {alarm_id}')
-    except:
-        logger.error(f'Unable to send notifications for alarm: {alarm_id}')
-        pa.log_traceback()
-        raise
+            raise ValueError(f'channel {name}: unsupported url scheme')
+        self.host = url.netloc
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+        self.local = threading.local()
+
+    def send(self, job, recip):
+        import http.client
+        payload = get_notification_payload(job, recip)
+        body = json.dumps(payload).encode()
+        headers = {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': payload['key']
+        }
+        while True:
+            conn = getattr(self.local, 'conn', None)
+            reused = conn is not None
+            if conn is None:
+                conn = self.connection_class(self.host, timeout=self.timeout)
+                self.local.conn = conn
+            try:
+                conn.request('POST', self.path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self.local.conn = None
+                # kept-alive connection may be closed by the server
+                if reused:
+                    continue
+                raise
+            if resp.will_close:
+                conn.close()
+                self.local.conn = None
+            break
+        if resp.status >= 300:
+            raise RuntimeError(f'channel {self.name}: HTTP {resp.status}')
+
+
+class CommandChannel(NotificationChannel):
+    """
+    Runs local command (with shell-like arguments) and passes notification
+    as JSON to its stdin
+    """
+
+    type = 'command'
+
+    def __init__(self, name, config):
+        super().__init__(name, config)
+        import shlex
+        try:
+            self.cmd = shlex.split(config['cmd'])
+        except KeyError:
+            raise ValueError(f'channel {name}: cmd is not specified')
+
+    def send(self, job, recip):
+        import subprocess
+        payload = json.dumps(get_notification_payload(job, recip))
+        subprocess.run(self.cmd,
+                       input=payload.encode(),
+                       stdout=subprocess.DEVNULL,
+                       timeout=self.timeout,
+                       check=True)
+
+
+class FileChannel(NotificationChannel):
+    """
+    Appends notifications as JSON lines to the local file (e.g. for testing)
+    """
+
+    type = 'file'
+
+    def __init__(self, name, config):
+        super().__init__(name, config)
+        try:
+            self.path = config['path']
+        except KeyError:
+            raise ValueError(f'channel {name}: path is not specified')
+        self.lock = threading.Lock()
+
+    def send(self, job, recip):
+        line = json.dumps(get_notification_payload(job, recip)) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as fh:
+                fh.write(line)
+
+
+CHANNEL_TYPES = {
+    c.type: c for c in (EmailChannel, WebhookChannel, CommandChannel,
+                        FileChannel)
+}
+
+# channel name -> channel
+channels = {}
+
+
+def parse_channels(config):
+    """
+    Creates notification channels, listed in "channels" config option
+
+    Channel options are set as channel.<name>.<option>, the channel type is
+    equal to its name if not specified
+    """
+    result = {}
+    for name in config.get('channels', 'email').split(','):
+        name = name.strip()
+        if not name:
+            continue
+        prefix = f'channel.{name}.'
+        ch_config = {
+            k[len(prefix):]: v
+            for k, v in config.items()
+            if k.startswith(prefix)
+        }
+        tp = ch_config.get('type', name)
+        try:
+            channel_class = CHANNEL_TYPES[tp]
+        except KeyError:
+            raise ValueError(f'channel {name}: unsupported type {tp}')
+        result[name] = channel_class(name, ch_config)
+    return result
 
 
 def init(config, **kwargs):
@@ -122,61 +2054,298 @@ def init(config, **kwargs):
     pa.register_apix(APIFuncs(), sys_api=False)
     p = pa.get_product()
     # undocummented internal function, don't use in own plugins
-    from eva.core import create_db_engine, format_db_uri
+    from eva.core import format_db_uri
     db = format_db_uri(config['db'])
-    flags.db = create_db_engine(db)
     logger.debug(f'alarmer.db = {db}')
+    flags.db = create_engine(db, config)
+    flags.db_ping_after = float(config.get('db_ping_after', 30))
+    logger.debug(f'alarmer.db_ping_after = {flags.db_ping_after}')
+    flags.userinfo_email_field = config.get('userinfo_email_field', 'email')
+    logger.debug(f'alarmer.userinfo_email_field = {flags.userinfo_email_field}')
+    flags.userinfo_team_field = config.get('userinfo_team_field', 'team')
+    logger.debug(f'alarmer.userinfo_team_field = {flags.userinfo_team_field}')
+    flags.log_batch_size = int(config.get('log_batch_size', 100))
+    logger.debug(f'alarmer.log_batch_size = {flags.log_batch_size}')
+    flags.log_flush_interval = int(config.get('log_flush_interval', 500)) / 1000
+    logger.debug(
+        f'alarmer.log_flush_interval = {flags.log_flush_interval * 1000:.0f}')
+    flags.log_page_max = int(config.get('log_page_max', 1000))
+    logger.debug(f'alarmer.log_page_max = {flags.log_page_max}')
+    flags.state_cache_ttl = float(config.get('state_cache_ttl', 60))
+    logger.debug(f'alarmer.state_cache_ttl = {flags.state_cache_ttl}')
+    flags.state_cache_check = val_to_boolean(
+        config.get('state_cache_check', False))
+    logger.debug(f'alarmer.state_cache_check = {flags.state_cache_check}')
+    flags.sub_reload_interval = float(config.get('sub_reload_interval', 30))
+    logger.debug(f'alarmer.sub_reload_interval = {flags.sub_reload_interval}')
+    flags.event_buffer_size = int(config.get('event_buffer_size', 1000))
+    logger.debug(f'alarmer.event_buffer_size = {flags.event_buffer_size}')
+    event_bus.resize(flags.event_buffer_size)
+    flags.event_poll_max = float(config.get('event_poll_max', 30))
+    logger.debug(f'alarmer.event_poll_max = {flags.event_poll_max}')
+    metrics.enabled = val_to_boolean(config.get('metrics', False))
+    logger.debug(f'alarmer.metrics = {metrics.enabled}')
+    flags.metrics_file = config.get('metrics_file')
+    logger.debug(f'alarmer.metrics_file = {flags.metrics_file}')
+    flags.metrics_interval = float(config.get('metrics_interval', 15))
+    logger.debug(f'alarmer.metrics_interval = {flags.metrics_interval}')
     if p.code == 'lm':
         pa.register_lmacro_object('notify', notify)
         flags.keep_log = int(config.get('keep_log', 86400))
         logger.debug(f'alarmer.keep_log = {flags.keep_log}')
-        flags.userinfo_email_field = config.get('userinfo_email_field', 'email')
+        keep_log_groups = parse_retention(config.get('keep_log_groups'), str)
+        logger.debug(f'alarmer.keep_log_groups = {keep_log_groups}')
+        keep_log_levels = parse_retention(config.get('keep_log_levels'), int)
+        logger.debug(f'alarmer.keep_log_levels = {keep_log_levels}')
+        flags.keep_log_rules = get_retention_rules(keep_log_groups,
+                                                   keep_log_levels)
+        flags.log_clean_chunk = int(config.get('log_clean_chunk', 1000))
+        logger.debug(f'alarmer.log_clean_chunk = {flags.log_clean_chunk}')
+        flags.log_clean_pause = float(config.get('log_clean_pause', 0.1))
+        logger.debug(f'alarmer.log_clean_pause = {flags.log_clean_pause}')
+        flags.log_archive = config.get('log_archive')
+        logger.debug(f'alarmer.log_archive = {flags.log_archive}')
+        flags.log_archive_keep = int(config.get('log_archive_keep', 30))
+        logger.debug(f'alarmer.log_archive_keep = {flags.log_archive_keep}')
+        flags.keep_stats_hourly = int(
+            config.get('keep_stats_hourly', 90 * 86400))
+        logger.debug(f'alarmer.keep_stats_hourly = {flags.keep_stats_hourly}')
+        flags.keep_stats_daily = int(config.get('keep_stats_daily', 0))
+        logger.debug(f'alarmer.keep_stats_daily = {flags.keep_stats_daily}')
+        flags.trigger_window = float(config.get('trigger_window', 0))
+        logger.debug(f'alarmer.trigger_window = {flags.trigger_window}')
+        flags.notify_min_interval = float(config.get('notify_min_interval', 0))
+        logger.debug(
+            f'alarmer.notify_min_interval = {flags.notify_min_interval}')
+        flags.digest_window = float(config.get('digest_window', 0))
+        logger.debug(f'alarmer.digest_window = {flags.digest_window}')
+        flags.digest_bypass_level = int(config.get('digest_bypass_level', 0))
+        logger.debug(
+            f'alarmer.digest_bypass_level = {flags.digest_bypass_level}')
+        # eva.mailer puts all recipients into To: header, so batching exposes
+        # subscriber addresses to each other
+        flags.notify_batch_size = int(config.get('notify_batch_size', 1))
+        logger.debug(f'alarmer.notify_batch_size = {flags.notify_batch_size}')
+        flags.notify_workers = int(config.get('notify_workers', 2))
+        logger.debug(f'alarmer.notify_workers = {flags.notify_workers}')
+        flags.notify_queue_size = int(config.get('notify_queue_size', 10000))
+        logger.debug(f'alarmer.notify_queue_size = {flags.notify_queue_size}')
+        flags.notify_queue_overflow = config.get('notify_queue_overflow',
+                                                 'block')
+        if flags.notify_queue_overflow not in ('block', 'drop',
+                                               'drop_oldest'):
+            raise ValueError('notify_queue_overflow should be '
+                             'block, drop or drop_oldest')
+        logger.debug(
+            f'alarmer.notify_queue_overflow = {flags.notify_queue_overflow}')
+        flags.notify_queue_timeout = float(
+            config.get('notify_queue_timeout', 5))
+        logger.debug(
+            f'alarmer.notify_queue_timeout = {flags.notify_queue_timeout}')
+        flags.notify_stop_timeout = float(config.get('notify_stop_timeout',
+                                                     30))
+        logger.debug(
+            f'alarmer.notify_stop_timeout = {flags.notify_stop_timeout}')
+        channels.clear()
+        channels.update(parse_channels(config))
+        for c in channels.values():
+            logger.debug(f'alarmer.channel.{c.name} = {c.type}, '
+                         f'levels: {sorted(c.levels)}, workers: {c.workers}, '
+                         f'timeout: {c.timeout}')
+        flags.spool = val_to_boolean(config.get('spool', True))
+        logger.debug(f'alarmer.spool = {flags.spool}')
+        flags.spool_flush_interval = int(config.get('spool_flush_interval',
+                                                    100)) / 1000
+        logger.debug('alarmer.spool_flush_interval = '
+                     f'{flags.spool_flush_interval * 1000:.0f}')
+        flags.spool_retry_interval = float(
+            config.get('spool_retry_interval', 5))
         logger.debug(
-            f'alarmer.userinfo_email_field = {flags.userinfo_email_field}')
+            f'alarmer.spool_retry_interval = {flags.spool_retry_interval}')
+        flags.spool_backoff = float(config.get('spool_backoff', 10))
+        logger.debug(f'alarmer.spool_backoff = {flags.spool_backoff}')
+        flags.spool_backoff_max = float(config.get('spool_backoff_max', 3600))
+        logger.debug(f'alarmer.spool_backoff_max = {flags.spool_backoff_max}')
+        flags.spool_max_attempts = int(config.get('spool_max_attempts', 10))
+        logger.debug(
+            f'alarmer.spool_max_attempts = {flags.spool_max_attempts}')
     elif p.code == 'sfa':
         lm = config['lm']
         if not lm.startswith('lm/'):
             lm = 'lm/' + lm
         logger.debug(f'alarmer.lm = {lm}')
         flags.lm = lm
+        flags.lm_max_inflight = int(config.get('lm_max_inflight', 10))
+        logger.debug(f'alarmer.lm_max_inflight = {flags.lm_max_inflight}')
+        flags.registry_ttl = float(config.get('registry_ttl', 300))
+        logger.debug(f'alarmer.registry_ttl = {flags.registry_ttl}')
         pa.register_apix(APIFuncs(), sys_api=False)
     else:
         RuntimeError(f'product not supported: {p}')
     flags.ready = True
 
 
+def get_schema_version(dbconn):
+    try:
+        r = dbconn.execute(sql('select version from alarmer_schema')).fetchone()
+    except:
+        return None
+    return r.version if r else None
+
+
+def set_schema_version(dbconn, version):
+    with dbconn.begin():
+        dbconn.execute(sql('delete from alarmer_schema'))
+        dbconn.execute(sql('insert into alarmer_schema(version) values (:v)'),
+                       v=version)
+
+
 def before_start(**kwargs):
     dbconn = get_db()
     meta = sa.MetaData()
+    t_alarmer_schema = sa.Table(
+        'alarmer_schema', meta,
+        sa.Column('version', sa.Integer(), primary_key=True))
     t_alarmer_sub = sa.Table(
         'alarmer_sub', meta, sa.Column('u', sa.String(128), primary_key=True),
         sa.Column('utp', sa.String(32), primary_key=True),
         sa.Column('alarm_id', sa.String(256), primary_key=True),
         sa.Column('level', sa.Integer()))
-    t_alarmer_log = sa.Table(
-        'alarmer_log', meta, sa.Column('u', sa.String(128), primary_key=True),
+    t_alarmer_sub_rule = sa.Table(
+        'alarmer_sub_rule', meta,
+        sa.Column('mask', sa.String(256), primary_key=True),
+        sa.Column('u', sa.String(128), primary_key=True),
         sa.Column('utp', sa.String(32), primary_key=True),
-        sa.Column('key_id', sa.String(64), primary_key=True),
+        sa.Column('team', sa.String(128), primary_key=True),
+        sa.Column('level', sa.Integer(), nullable=False))
+    t_alarmer_log = sa.Table(
+        'alarmer_log', meta, sa.Column('id', sa.Integer()),
+        sa.Column('u', sa.String(128), nullable=False),
+        sa.Column('utp', sa.String(32), nullable=False),
+        sa.Column('key_id', sa.String(64), nullable=False),
+        sa.Column('alarm_id', sa.String(256), nullable=False),
+        sa.Column('description', sa.String(256), nullable=False),
+        sa.Column('action', sa.String(1), nullable=False),
+        sa.Column('t', sa.Float(), nullable=False),
+        sa.Column('level', sa.Integer(), nullable=False),
+        sa.Column('hits', sa.Integer(), nullable=False, server_default='1'),
+        sa.PrimaryKeyConstraint('id', name='alarmer_log_pk'),
+        sa.Index('alarmer_log_alarm_id_t', 'alarm_id', 't'),
+        sa.Index('alarmer_log_t', 't'))
+    t_alarmer_stats = sa.Table(
+        'alarmer_stats', meta,
         sa.Column('alarm_id', sa.String(256), primary_key=True),
-        sa.Column('description', sa.String(256), primary_key=True),
-        sa.Column('action', sa.String(1), primary_key=True),
-        sa.Column('t', sa.Float(), primary_key=True),
-        sa.Column('level', sa.Integer(), primary_key=True))
+        sa.Column('period', sa.Integer(), primary_key=True),
+        sa.Column('t', sa.Integer(), primary_key=True),
+        sa.Column('grp', sa.String(256), nullable=False),
+        sa.Column('triggers', sa.Integer(), nullable=False),
+        sa.Column('warnings', sa.Integer(), nullable=False),
+        sa.Column('alarms', sa.Integer(), nullable=False),
+        sa.Column('acks', sa.Integer(), nullable=False),
+        sa.Column('hits', sa.Integer(), nullable=False),
+        sa.Column('ack_count', sa.Integer(), nullable=False),
+        sa.Column('ack_time', sa.Float(), nullable=False),
+        sa.Index('alarmer_stats_period_t', 'period', 't'))
+    t_alarmer_spool = sa.Table(
+        'alarmer_spool', meta, sa.Column('ikey',
+                                         sa.String(40),
+                                         primary_key=True),
+        sa.Column('channel', sa.String(64), nullable=False),
+        sa.Column('alarm_id', sa.String(256), nullable=False),
+        sa.Column('level', sa.Integer(), nullable=False),
+        sa.Column('description', sa.String(256), nullable=False),
+        sa.Column('t', sa.Float(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_t', sa.Float(), nullable=False),
+        sa.Index('alarmer_spool_next_t', 'next_t'))
+    # schema migrations are performed by LM PLC only
+    migrate = pa.get_product().code == 'lm'
+    version = get_schema_version(dbconn)
+    insp = sa.inspect(flags.db)
+    tables = insp.get_table_names()
+    if version is None:
+        if 'alarmer_log_v0' in tables or (
+                'alarmer_log' in tables and 'id'
+                not in [c['name'] for c in insp.get_columns('alarmer_log')]):
+            version = 0
+        else:
+            version = SCHEMA_VERSION
+    if version < 1 and migrate and 'alarmer_log_v0' not in tables:
+        logger.warning('migrating alarmer_log to schema v1')
+        dbconn.execute(sql('alter table alarmer_log rename to alarmer_log_v0'))
     try:
         meta.create_all(dbconn)
     except:
         pa.log_traceback()
         logger.error('unable to create alarme tables in db')
+    if migrate:
+        log_columns = sa.inspect(flags.db).get_columns('alarmer_log')
+        if 'hits' not in [c['name'] for c in log_columns]:
+            logger.warning('migrating alarmer_log to schema v2')
+            dbconn.execute(
+                sql('alter table alarmer_log add hits integer not null '
+                    'default 1'))
+        if version < 1:
+            flags.migrate_log = True
+        else:
+            set_schema_version(dbconn, SCHEMA_VERSION)
+    try:
+        sub_index.load()
+    except:
+        pa.log_traceback()
+        logger.error('unable to load alarm subscriptions, '
+                     'will use the database directly')
 
 
 def start(**kwargs):
+    try:
+        state_cache.seed()
+    except:
+        pa.log_traceback()
+        logger.error('unable to seed alarm state cache')
+    log_writer.start(flags.log_batch_size, flags.log_flush_interval)
+    if flags.sub_reload_interval:
+        sub_index_reloader.start(_delay=flags.sub_reload_interval)
+    if pa.get_product().code == 'sfa' and flags.registry_ttl:
+        registry_reloader.start(_delay=flags.registry_ttl)
+    if flags.metrics_file:
+        metrics_writer.start(_delay=flags.metrics_interval)
     if pa.get_product().code == 'lm':
+        for c in channels.values():
+            c.dispatcher.start()
+        if flags.spool:
+            spool.start(flags.log_batch_size, flags.spool_flush_interval)
+            try:
+                spool.purge_channels()
+                pending = spool.pending()
+                if pending:
+                    logger.warning(f'{pending} alarm notification(s) in spool, '
+                                   'replaying')
+            except:
+                pa.log_traceback()
+            spool_retrier.start(_delay=flags.spool_retry_interval)
+        if flags.digest_window:
+            digest_flusher.start()
         log_cleaner.start()
+        if flags.migrate_log:
+            log_migrator.start()
 
 
 def stop(**kwargs):
+    sub_index_reloader.stop()
+    registry_reloader.stop()
+    metrics_writer.stop()
     if pa.get_product().code == 'lm':
+        log_migrator.stop()
         log_cleaner.stop()
+        spool_retrier.stop()
+        for c in channels.values():
+            c.dispatcher.stop()
+        if flags.digest_window:
+            digest_flusher.stop()
+            digest.flush(force=True)
+        spool.stop()
+    log_writer.stop()
 
 
 class APIFuncs(pa.APIX):
@@ -218,6 +2387,12 @@ class APIFuncs(pa.APIX):
             db.execute(
                 sql('insert into alarmer_sub(u, utp, alarm_id, level) '
                     'values (:u, :utp, :alarm_id, :level)'), **kw)
+        email = db.execute(sql('select value from userinfo where '
+                               'name=:name and u=:u and utp=:utp'),
+                           name=flags.userinfo_email_field,
+                           u=u,
+                           utp=utp).fetchone()
+        sub_index.subscribe(i, u, utp, l, email.value if email else None)
         return True
 
     @pa.api_log_i
@@ -239,6 +2414,7 @@ class APIFuncs(pa.APIX):
         db.execute(
             sql('delete from alarmer_sub where u=:u '
                 'and utp=:utp and alarm_id=:alarm_id'), **kw)
+        sub_index.unsubscribe(i, u, utp)
         return True
 
     @pa.api_log_i
@@ -257,200 +2433,230 @@ class APIFuncs(pa.APIX):
                     'from alarmer_sub where u=:u and utp=:utp'), **kw)
         ]
 
+    @staticmethod
+    def _parse_sub_rule(kwargs, params, types):
+        result = pa.parse_api_params(kwargs, params, types)
+        m, u, utp, team = result[0], result[-3], result[-2], result[-1]
+        if bool(u) == bool(team):
+            raise pa.InvalidParameter(
+                'either user "u" or team "team" should be specified')
+        try:
+            compile_alarm_mask(m)
+        except ValueError as e:
+            raise pa.InvalidParameter(str(e))
+        return (*result[:-3], u or '', (utp or '') if u else '', team or '')
+
+    @pa.api_log_w
+    @pa.api_need_master
+    def subscribe_rule(self, **kwargs):
+        m, l, u, utp, team = self._parse_sub_rule(
+            kwargs, ['m', 'l', 'u', 'utp', 'team'], 'SIsss')
+        if l < 1 or l > 2:
+            raise pa.InvalidParameter('param "l" should be 1 or 2')
+        kw = {'mask': m, 'u': u, 'utp': utp, 'team': team, 'level': l}
+        db = get_db()
+        if not db.execute(
+                sql('update alarmer_sub_rule set level=:level '
+                    'where mask=:mask and u=:u and utp=:utp and team=:team'),
+                **kw).rowcount:
+            db.execute(
+                sql('insert into alarmer_sub_rule(mask, u, utp, team, level) '
+                    'values (:mask, :u, :utp, :team, :level)'), **kw)
+        sub_index.load()
+        return True
+
+    @pa.api_log_w
+    @pa.api_need_master
+    def unsubscribe_rule(self, **kwargs):
+        m, u, utp, team = self._parse_sub_rule(kwargs,
+                                               ['m', 'u', 'utp', 'team'],
+                                               'Ssss')
+        if not get_db().execute(
+                sql('delete from alarmer_sub_rule where mask=:mask '
+                    'and u=:u and utp=:utp and team=:team'),
+                mask=m,
+                u=u,
+                utp=utp,
+                team=team).rowcount:
+            raise pa.ResourceNotFound
+        sub_index.load()
+        return True
+
+    @pa.api_log_i
+    @pa.api_need_master
+    def list_subscription_rules(self, **kwargs):
+        return [
+            dict(x) for x in get_db().execute(
+                sql('select mask, level, u, utp, team from alarmer_sub_rule '
+                    'order by mask, team, u, utp'))
+        ]
+
     @pa.api_log_i
     @pa.api_need_master
     def create(self, **kwargs):
         u, d, g, rw, ra, save = pa.parse_api_params(kwargs, 'udgwaS', 'sssRRb')
         import uuid
         alarm_id = u if u else str(uuid.uuid4())
-        alarm_full_id = f'{g if g else ""}{"/" if g else ""}{alarm_id}'
-        lvar_id = f'alarmer{"/" if g else ""}{g if g else ""}/{alarm_id}'
-        try:
-            result = pa.api_call('management_api_call',
-                                 i=flags.lm,
-                                 f='create_lvar',
-                                 p={
-                                     'i': lvar_id,
-                                     'save': save and not d
-                                 })
-            if result['code'] != apiclient.result_ok:
-                raise pa.FunctionFailed(f'unable to create lvar {lvar_id} at'
-                                        f' {flags.lm} ({result["code"]})')
-            if d:
-                result = pa.api_call('management_api_call',
-                                     i=flags.lm,
-                                     f='set_prop',
-                                     p={
-                                         'i': lvar_id,
-                                         'p': 'description',
-                                         'v': d,
-                                         'save': save
-                                     })
-                if result['code'] != apiclient.result_ok:
-                    raise pa.FunctionFailed(
-                        f'unable to set lvar description {lvar_id} at '
-                        f'{flags.lm} ({result["code"]})')
-            result = pa.api_call('management_api_call',
-                                 i=flags.lm,
-                                 f='create_rule',
-                                 p={
-                                     'u': f'{alarm_id}_w',
-                                     'v': rw
-                                 })
-            if result['code'] != apiclient.result_ok:
-                raise pa.FunctionFailed(
-                    f'unable to create warning rule {alarm_id}w at '
-                    f'{flags.lm} ({result["code"]})')
-            result = pa.api_call('management_api_call',
-                                 i=flags.lm,
-                                 f='set_rule_prop',
-                                 p={
-                                     'i': f'{alarm_id}_w',
-                                     'v': {
-                                         'description': d,
-                                         'macro': '@x_alarmer_notify',
-                                         'macro_args': [alarm_full_id, 1],
-                                         'priority': 1,
-                                         'enabled': True
-                                     },
-                                     'save': save
-                                 })
-            if result['code'] != apiclient.result_ok:
-                raise pa.FunctionFailed(
-                    f'unable to set warning rule {alarm_id}_w props '
-                    f'at {flags.lm} ({result["code"]})')
-            result = pa.api_call('management_api_call',
-                                 i=flags.lm,
-                                 f='create_rule',
-                                 p={
-                                     'u': f'{alarm_id}_a',
-                                     'v': ra
-                                 })
-            if result['code'] != apiclient.result_ok:
-                raise pa.FunctionFailed(
-                    f'unable to create alarm rule {alarm_id}w at '
-                    f'{flags.lm} ({result["code"]})')
-            result = pa.api_call('management_api_call',
-                                 i=flags.lm,
-                                 f='set_rule_prop',
-                                 p={
-                                     'i': f'{alarm_id}_a',
-                                     'v': {
-                                         'description': d,
-                                         'macro': '@x_alarmer_notify',
-                                         'macro_args': [alarm_full_id, 2],
-                                         'priority': 1,
-                                         'enabled': True
-                                     },
-                                     'save': save
-                                 })
-            if result['code'] != apiclient.result_ok:
-                raise pa.FunctionFailed(
-                    f'unable to set alarm rule {alarm_id}_a props '
-                    f'at {flags.lm} ({result["code"]})')
-            pa.api_call('reload_controller', i=flags.lm)
-        except:
-            pa.log_traceback()
-            destroy_alarm(f'{g if g else ""}{"/" if g else ""}{alarm_id}')
-            raise
-        return {'id': alarm_full_id, 'lvar_id': lvar_id}
+        # failed creation is rolled back by create_alarm
+        result = create_alarm(alarm_id, d, g, rw, ra, save)
+        pa.api_call('reload_controller', i=flags.lm)
+        registry.set(result['id'], d)
+        return result
+
+    @pa.api_log_i
+    @pa.api_need_master
+    def create_many(self, **kwargs):
+        alarms, save = pa.parse_api_params(kwargs, ['alarms', 'save'], '.b')
+        if not isinstance(alarms, list):
+            raise pa.InvalidParameter('param "alarms" should be a list')
+        import uuid
+        specs = []
+        result = []
+        ids = set()
+        for a in alarms:
+            if not isinstance(a, dict):
+                raise pa.InvalidParameter('alarm specs should be dicts')
+            g = a.get('g')
+            alarm_id = a.get('u') or str(uuid.uuid4())
+            r = {'id': f'{g if g else ""}{"/" if g else ""}{alarm_id}'}
+            if not isinstance(a.get('w'), dict) or not isinstance(
+                    a.get('a'), dict):
+                r['ok'] = False
+                r['error'] = 'warning and alarm rule props are required'
+            elif alarm_id in ids:
+                # rule ids are derived from alarm ids without groups
+                r['ok'] = False
+                r['error'] = 'duplicate alarm id'
+            else:
+                ids.add(alarm_id)
+                specs.append((r, (alarm_id, a.get('d'), g, a['w'], a['a'])))
+            result.append(r)
+
+        def _create(spec):
+            r, args = spec
+            try:
+                r.update(create_alarm(*args, save=False))
+                r['ok'] = True
+                registry.set(r['id'], args[1])
+            except Exception as e:
+                # failed creation is rolled back by create_alarm
+                r['ok'] = False
+                r['error'] = str(e)
+
+        if specs:
+            run_concurrently(_create, specs)
+            if save:
+                lm_call('save', {}, 'unable to save configuration')
+            pa.api_call('reload_controller', i=flags.lm)
+        return result
 
     @pa.api_log_i
     @pa.api_need_master
     def set_description(self, **kwargs):
         i, d, save = pa.parse_api_params(kwargs, 'idS', 'Ssb')
-        lvar_id = f'lvar:alarmer/{i}'
-        rule_id = i.rsplit('/')[-1]
-        result = pa.api_call('management_api_call',
-                             i=flags.lm,
-                             f='set_prop',
-                             p={
-                                 'i': lvar_id,
-                                 'p': 'description',
-                                 'v': d,
-                                 'save': save
-                             })
-        if result['code'] != apiclient.result_ok:
-            raise pa.FunctionFailed(
-                f'unable to set lvar description {lvar_id} at '
-                f'{flags.lm} ({result["code"]})')
-        for rtp in ['w', 'a']:
-            result = pa.api_call('management_api_call',
-                                 i=flags.lm,
-                                 f='set_rule_prop',
-                                 p={
-                                     'i': f'{rule_id}_{rtp}',
-                                     'p': 'description',
-                                     'v': d,
-                                     'save': save
-                                 })
-            if result['code'] != apiclient.result_ok:
-                raise pa.FunctionFailed(
-                    f'unable to set rule description {rule_id}_{rtp} at '
-                    f'{flags.lm} ({result["code"]})')
+        set_alarm_description(i, d, save)
         pa.api_call('reload_controller', i=flags.lm)
         return True
 
+    @pa.api_log_i
+    @pa.api_need_master
+    def set_description_many(self, **kwargs):
+        alarms, save = pa.parse_api_params(kwargs, ['alarms', 'save'], '.b')
+        items = [(a.get('i'), a.get('d'), save)
+                 for a in parse_bulk_specs(alarms)]
+        result = run_bulk(set_alarm_description, items)
+        pa.api_call('reload_controller', i=flags.lm)
+        return result
+
     @pa.api_log_i
     @pa.api_need_master
     def set_rule_props(self, **kwargs):
         i, rw, ra, save = pa.parse_api_params(kwargs, 'iwaS', 'S..b')
-        rule_id = i.rsplit('/')[-1]
-        if rw:
-            result = pa.api_call('management_api_call',
-                                 i=flags.lm,
-                                 f='set_rule_prop',
-                                 p={
-                                     'i': f'{rule_id}_w',
-                                     'v': rw,
-                                     'save': save
-                                 })
-            if result['code'] != apiclient.result_ok:
-                raise pa.FunctionFailed(
-                    f'unable to set warning rule props {rule_id}_w at '
-                    f'{flags.lm} ({result["code"]})')
-        if ra:
-            result = pa.api_call('management_api_call',
-                                 i=flags.lm,
-                                 f='set_rule_prop',
-                                 p={
-                                     'i': f'{rule_id}_a',
-                                     'v': ra,
-                                     'save': save
-                                 })
-            if result['code'] != apiclient.result_ok:
-                raise pa.FunctionFailed(
-                    f'unable to set alarm rule props {rule_id}_a at '
-                    f'{flags.lm} ({result["code"]})')
+        set_alarm_rule_props(i, rw, ra, save)
         return True
 
+    @pa.api_log_i
+    @pa.api_need_master
+    def set_rule_props_many(self, **kwargs):
+        alarms, save = pa.parse_api_params(kwargs, ['alarms', 'save'], '.b')
+        items = [(a.get('i'), a.get('w'), a.get('a'), save)
+                 for a in parse_bulk_specs(alarms)]
+        return run_bulk(set_alarm_rule_props, items)
+
     @pa.api_log_i
     @pa.api_need_master
     def list_rule_props(self, **kwargs):
         i = pa.parse_api_params(kwargs, 'i', 'S')
-        rules = {}
-        rule_id = i.rsplit('/')[-1]
-        for rtp in ['w', 'a']:
-            result = pa.api_call('management_api_call',
-                                 i=flags.lm,
-                                 f='list_rule_props',
-                                 p={
-                                     'i': f'{rule_id}_{rtp}',
-                                 })
-            if result['code'] != apiclient.result_ok:
-                raise pa.FunctionFailed(
-                    f'unable to list rule props {rule_id}_{rtp} at '
-                    f'{flags.lm} ({result["code"]})')
-            d = result['data']
-            for x in [
-                    'enabled', 'macro', 'macro_args', 'macro_kwargs', 'priority'
-            ]:
-                try:
-                    del d[x]
-                except KeyError:
-                    pass
-            rules['r' + rtp] = d
-        return rules
+        return get_alarm_rule_props(i)
+
+    @pa.api_log_i
+    @pa.api_need_master
+    def export(self, **kwargs):
+        g, f = pa.parse_api_params(kwargs, 'gf', 'ss')
+        if not f:
+            return ''.join(
+                json.dumps(d) + '\n' for d in export_alarms(g))
+        import os
+        tmp = f'{f}.tmp'
+        n = 0
+        failed = []
+        try:
+            with open(tmp, 'w') as fh:
+                for d in export_alarms(g, failed):
+                    fh.write(json.dumps(d) + '\n')
+                    n += 1
+            os.replace(tmp, f)
+        except:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        return {'alarms': n, 'failed': failed}
+
+    @pa.api_log_w
+    @pa.api_need_master
+    def _import(self, **kwargs):
+        f, data, dry_run, save = pa.parse_api_params(
+            kwargs, ['f', 'data', 'dry_run', 'save'], 's.bb')
+        if f:
+            with open(f) as fh:
+                return import_alarms(fh, dry_run, save)
+        elif isinstance(data, list):
+            return import_alarms(data, dry_run, save)
+        elif data:
+            import io
+            return import_alarms(io.StringIO(str(data)), dry_run, save)
+        else:
+            raise pa.InvalidParameter('file "f" or "data" should be specified')
+
+    @pa.api_log_i
+    def list(self, **kwargs):
+        k, g, l, r = pa.parse_function_params(kwargs, 'kglr', 'Ssib')
+        if r and not pa.key_check(k, master=True):
+            raise pa.AccessDenied('master key is required to list rule props')
+        result = []
+        for alarm_id, info in registry.get(rules=r).items():
+            if g and not alarm_id.startswith(g.strip('/') + '/'):
+                continue
+            lvar = pa.get_item(f'lvar:alarmer/{alarm_id}')
+            if not lvar or not pa.key_check(k, lvar, ro_op=True):
+                continue
+            level = get_lvar_level(lvar)
+            if l is not None and (level or 0) != l:
+                continue
+            d = {
+                'id': alarm_id,
+                'group': alarm_id.rsplit('/', 1)[0] if '/' in alarm_id else '',
+                'description': info['description'],
+                'level': level or 0,
+                'enabled': lvar.status == 1,
+                'subscribers': len(sub_index.get_subscribers(alarm_id))
+            }
+            if r:
+                d.update(info['rules'] or {})
+            result.append(d)
+        return sorted(result, key=lambda x: x['id'])
 
     @pa.api_log_w
     @pa.api_need_master
@@ -458,6 +2664,39 @@ class APIFuncs(pa.APIX):
         i = pa.parse_api_params(kwargs, 'i', 'S')
         return destroy_alarm(i)
 
+    @pa.api_log_w
+    @pa.api_need_master
+    def destroy_many(self, **kwargs):
+        i, g = pa.parse_api_params(kwargs, 'ig', '.s')
+        if i is None:
+            ids = []
+        elif isinstance(i, list):
+            ids = i
+        else:
+            ids = [x.strip() for x in str(i).split(',') if x.strip()]
+        if g:
+            ids += list_alarm_ids(g)
+        if not ids and not g:
+            raise pa.InvalidParameter('alarm ids or group should be specified')
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return []
+        result = run_bulk(destroy_alarm_items, [(x,) for x in ids])
+        pa.api_call('reload_controller', i=flags.lm)
+        try:
+            get_db().execute(sql('delete from alarmer_sub '
+                                 'where alarm_id in :ids').bindparams(
+                                     sa.bindparam('ids', expanding=True)),
+                             ids=ids)
+            for x in ids:
+                sub_index.drop(x)
+        except:
+            pa.log_traceback()
+            for r in result:
+                r['ok'] = False
+                r['error'] = 'unable to delete subscriptions'
+        return result
+
     @pa.api_log_i
     def ack(self, **kwargs):
         k, i = pa.parse_function_params(kwargs, 'ki', 'SS')
@@ -466,9 +2705,15 @@ class APIFuncs(pa.APIX):
             raise pa.ResourceNotFound
         if not pa.key_check(k, lvar):
             raise pa.AccessDenied
-        lv = pa.api_call("state", i=f'lvar:alarmer/{i}', full=True)
-        pa.api_call("clear", i=f'lvar:alarmer/{i}')
-        db = get_db()
+        lv = state_cache.get(i)
+        prev_value = lv['value']
+        state_cache.set_value(i, 0)
+        try:
+            pa.api_call("clear", i=f'lvar:alarmer/{i}')
+        except:
+            state_cache.set_value(i, prev_value)
+            raise
+        metrics.inc('alarmer_acks_total')
         u = pa.get_aci('u')
         if not u:
             u = ''
@@ -476,32 +2721,169 @@ class APIFuncs(pa.APIX):
         key_id = pa.get_aci('key_id')
         if not utp:
             utp = ''
-        try:
-            db.execute(sql(
-                'insert into alarmer_log'
-                '(u, utp, key_id, alarm_id, description, action, t, level)'
-                'values (:u, :utp, :key_id, :alarm_id, :d, :action, :t, :level)'
-            ),
-                       u=u,
-                       utp=utp,
-                       key_id=key_id,
-                       alarm_id=i,
-                       d=lv['description'],
-                       action='A',
-                       t=time.time(),
-                       level=0)
-        except:
-            logger.error(f'Unable to insert log record for alarm: {i}')
-            pa.log_traceback()
+        t = time.time()
+        log_writer.append(u=u,
+                          utp=utp,
+                          key_id=key_id or '',
+                          alarm_id=i,
+                          description=lv['description'],
+                          action='A',
+                          t=t,
+                          level=0)
+        if value_to_level(prev_value):
+            event_bus.publish(alarm_id=i,
+                              action='A',
+                              level=0,
+                              description=lv['description'],
+                              u=u,
+                              utp=utp,
+                              key_id=key_id or '',
+                              t=t)
         return True
 
+    @pa.api_log_d
+    def get_events(self, **kwargs):
+        k, seq, n, w = pa.parse_function_params(kwargs, ['k', 'seq', 'n', 'w'],
+                                                'Siif')
+        if not n:
+            n = 100
+        elif n < 1:
+            raise pa.InvalidParameter('param "n" should be positive')
+        elif n > flags.log_page_max:
+            n = flags.log_page_max
+        if w is None or w < 0:
+            w = 0
+        elif w > flags.event_poll_max:
+            w = flags.event_poll_max
+        acl = {}
+
+        def check_access(ev):
+            alarm_id = ev['alarm_id']
+            try:
+                return acl[alarm_id]
+            except KeyError:
+                lvar = pa.get_item(f'lvar:alarmer/{alarm_id}')
+                acl[alarm_id] = result = bool(
+                    lvar and pa.key_check(k, lvar, ro_op=True))
+                return result
+
+        events, seq, reset = event_bus.get(seq, n, w, check_access)
+        return {'data': events, 'seq': seq, 'reset': reset}
+
+    @pa.api_log_i
+    @pa.api_need_master
+    def status(self, **kwargs):
+        return {
+            'sub_index': sub_index.serialize(),
+            'registry': registry.serialize(),
+            'state_cache': state_cache.serialize(),
+            'trigger_gate': trigger_gate.serialize(),
+            'event_bus': event_bus.serialize(),
+            'channels': {c.name: c.serialize() for c in channels.values()},
+            'spool': spool.serialize(),
+            'digest': digest.serialize(),
+            'log_writer': log_writer.serialize(),
+            'stats_rollup': stats_rollup.serialize(),
+            'log_cleaner': log_cleaner_stats.serialize()
+        }
+
+    @pa.api_log_d
+    @pa.api_need_master
+    def metrics(self, **kwargs):
+        k, fmt = pa.parse_function_params(kwargs, 'kf', 'Ss')
+        if fmt == 'text':
+            return metrics.render()
+        elif fmt:
+            raise pa.InvalidParameter('param "f" should be text')
+        return metrics.collect()
+
+    @pa.api_log_i
+    def stats(self, **kwargs):
+        k, i, g, t_start, t_end, p, top = pa.parse_function_params(
+            kwargs, ['k', 'i', 'g', 't_start', 't_end', 'p', 'top'],
+            'Sssffsi')
+        if i:
+            lvar = pa.get_item(f'lvar:alarmer/{i}')
+            if not lvar:
+                raise pa.ResourceNotFound
+            if not pa.key_check(k, lvar, ro_op=True):
+                raise pa.AccessDenied
+        elif not pa.key_check(k, master=True):
+            raise pa.AccessDenied(
+                'master key is required to view unfiltered statistics')
+        if p is None or p == 'day':
+            period = 86400
+        elif p == 'hour':
+            period = 3600
+        else:
+            raise pa.InvalidParameter('param "p" should be hour or day')
+        if top is None:
+            top = 10
+        elif top < 0:
+            raise pa.InvalidParameter('param "top" should not be negative')
+        cond = ['period=:period']
+        kw = {'period': period}
+        if i:
+            cond.append('alarm_id=:i')
+            kw['i'] = i
+        elif g:
+            g = g.strip('/')
+            cond.append("(grp=:g or grp like :gp escape '!')")
+            kw['g'] = g
+            kw['gp'] = like_escape(g) + '/%'
+        if t_start is not None:
+            # periods, which include t_start
+            cond.append('t>:t_start')
+            kw['t_start'] = t_start - period
+        if t_end is not None:
+            cond.append('t<=:t_end')
+            kw['t_end'] = t_end
+        w = ' and '.join(cond)
+        fields = ('sum(triggers) as triggers, sum(warnings) as warnings, '
+                  'sum(alarms) as alarms, sum(acks) as acks, '
+                  'sum(hits) as hits, sum(ack_count) as ack_count, '
+                  'sum(ack_time) as ack_time')
+
+        def fmt(r, **kwargs):
+            d = kwargs
+            for f in ('triggers', 'warnings', 'alarms', 'acks', 'hits'):
+                d[f] = r[f] or 0
+            d['mtta'] = r['ack_time'] / r['ack_count'] if r['ack_count'] \
+                else None
+            return d
+
+        db = get_db()
+        result = fmt(
+            db.execute(sql(f'select {fields} from alarmer_stats where {w}'),
+                       **kw).fetchone())
+        result['series'] = [
+            fmt(r, t=r['t']) for r in db.execute(
+                sql(f'select t, {fields} from alarmer_stats where {w} '
+                    'group by t order by t'), **kw)
+        ]
+        if not i and top:
+            result['top'] = [
+                fmt(r, id=r['alarm_id']) for r in db.execute(
+                    sql(f'select alarm_id, {fields} from alarmer_stats '
+                        f'where {w} group by alarm_id '
+                        'order by sum(triggers)+sum(hits) desc, alarm_id '
+                        'limit :top'),
+                    top=top,
+                    **kw)
+            ]
+        return result
+
     @pa.api_log_i
     def get_log(self, **kwargs):
-        k, i, n = pa.parse_function_params(kwargs, 'kin', 'Ssi')
-        lvar = pa.get_item(f'lvar:alarmer/{i}')
-        if not lvar:
-            raise pa.ResourceNotFound
+        k, i, n, t_start, t_end, before_t, before_id, action, l, paged = \
+            pa.parse_function_params(kwargs, [
+                'k', 'i', 'n', 't_start', 't_end', 'before_t', 'before_id',
+                'action', 'l', 'paged'
+            ], 'Ssifffisib')
         if i:
+            lvar = pa.get_item(f'lvar:alarmer/{i}')
+            if not lvar:
+                raise pa.ResourceNotFound
             if not pa.key_check(k, lvar, ro_op=True):
                 raise pa.AccessDenied
         else:
@@ -510,28 +2892,336 @@ class APIFuncs(pa.APIX):
                     'master key is required to view unfiltered log')
         if not n:
             n = 100
-        db = get_db()
-        kw = {}
+        elif n < 1:
+            raise pa.InvalidParameter('param "n" should be positive')
+        elif n > flags.log_page_max:
+            n = flags.log_page_max
+        if action and action not in ('T', 'A'):
+            raise pa.InvalidParameter('param "action" should be T or A')
+        cond = []
+        kw = {'n': n}
         if i:
-            w = ' where alarm_id=:i'
+            cond.append('alarm_id=:i')
             kw['i'] = i
+        if t_start is not None:
+            cond.append('t>=:t_start')
+            kw['t_start'] = t_start
+        if t_end is not None:
+            cond.append('t<=:t_end')
+            kw['t_end'] = t_end
+        if before_t is not None:
+            if before_id is not None:
+                cond.append('(t<:before_t or (t=:before_t and id<:before_id))')
+                kw['before_id'] = before_id
+            else:
+                cond.append('t<:before_t')
+            kw['before_t'] = before_t
+        if action:
+            cond.append('action=:action')
+            kw['action'] = action
+        if l is not None:
+            cond.append('level=:level')
+            kw['level'] = l
+        w = f' where {" and ".join(cond)}' if cond else ''
+        result = [
+            dict(d) for d in get_db().execute(
+                sql('select id, u, utp, key_id, alarm_id, description, '
+                    f'action, t, level, hits from alarmer_log{w} '
+                    'order by t desc, id desc limit :n'), **kw)
+        ]
+        if paged:
+            if len(result) == n:
+                cursor = {
+                    'before_t': result[-1]['t'],
+                    'before_id': result[-1]['id']
+                }
+            else:
+                cursor = None
+            return {'data': result, 'cursor': cursor}
         else:
-            w = ''
-        r = db.execute(
-            sql(f'select u, utp, key_id, alarm_id, description, '
-                f'action, t, level from'
-                f' alarmer_log {w} order by t desc limit {n}'), **kw)
-        result = []
-        while True:
-            d = r.fetchone()
-            if not d:
-                break
-            result.append(dict(d))
-        return result
+            return result
+
+
+# "import" is a reserved word, API method x_alarmer_import
+setattr(APIFuncs, 'import', APIFuncs._import)
+
+
+def lm_call(f, p, error):
+    """
+    Calls LM PLC management API function, raises FunctionFailed on errors
+    """
+    result = pa.api_call('management_api_call', i=flags.lm, f=f, p=p)
+    if result['code'] != apiclient.result_ok:
+        raise pa.FunctionFailed(f'{error} at {flags.lm} ({result["code"]})')
+    return result
+
+
+def run_concurrently(func, items):
+    """
+    Calls func for each item with max lm_max_inflight calls in parallel
+    """
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=flags.lm_max_inflight) as executor:
+        return list(executor.map(func, items))
+
+
+def create_alarm(alarm_id, d, g, rw, ra, save):
+    """
+    Creates alarm lvar and rules, LM PLC controller should be reloaded after
+
+    If creation fails, the lvar and rules, created by this call, are
+    destroyed. Existing items (e.g. if the lvar already exists) are never
+    touched.
+    """
+    alarm_full_id = f'{g if g else ""}{"/" if g else ""}{alarm_id}'
+    lvar_id = f'alarmer{"/" if g else ""}{g if g else ""}/{alarm_id}'
+    created = []
+    try:
+        lm_call('create_lvar', {
+            'i': lvar_id,
+            'save': save and not d
+        }, f'unable to create lvar {lvar_id}')
+        created.append(('destroy_lvar', lvar_id))
+        if d:
+            lm_call('set_prop', {
+                'i': lvar_id,
+                'p': 'description',
+                'v': d,
+                'save': save
+            }, f'unable to set lvar description {lvar_id}')
+        for rtp, level, props, name in (('w', 1, rw, 'warning'),
+                                        ('a', 2, ra, 'alarm')):
+            lm_call('create_rule', {
+                'u': f'{alarm_id}_{rtp}',
+                'v': props
+            }, f'unable to create {name} rule {alarm_id}_{rtp}')
+            created.append(('destroy_rule', f'{alarm_id}_{rtp}'))
+            lm_call(
+                'set_rule_prop', {
+                    'i': f'{alarm_id}_{rtp}',
+                    'v': {
+                        'description': d,
+                        'macro': '@x_alarmer_notify',
+                        'macro_args': [alarm_full_id, level],
+                        'priority': 1,
+                        'enabled': True
+                    },
+                    'save': save
+                }, f'unable to set {name} rule {alarm_id}_{rtp} props')
+    except:
+        for f, i in reversed(created):
+            result = pa.api_call('management_api_call',
+                                 i=flags.lm,
+                                 f=f,
+                                 p={'i': i})
+            if result['code'] != apiclient.result_ok:
+                logger.error(f'unable to roll back {i} at {flags.lm} '
+                             f'({result["code"]})')
+        raise
+    return {'id': alarm_full_id, 'lvar_id': lvar_id}
+
+
+def set_alarm_description(i, d, save):
+    """
+    Sets alarm lvar and rules description, LM PLC controller should be
+    reloaded after
+    """
+    lvar_id = f'lvar:alarmer/{i}'
+    rule_id = i.rsplit('/')[-1]
+    lm_call('set_prop', {
+        'i': lvar_id,
+        'p': 'description',
+        'v': d,
+        'save': save
+    }, f'unable to set lvar description {lvar_id}')
+    for rtp in ['w', 'a']:
+        lm_call('set_rule_prop', {
+            'i': f'{rule_id}_{rtp}',
+            'p': 'description',
+            'v': d,
+            'save': save
+        }, f'unable to set rule description {rule_id}_{rtp}')
+    registry.set_description(i, d)
+
+
+def set_alarm_rule_props(i, rw, ra, save):
+    rule_id = i.rsplit('/')[-1]
+    if rw:
+        lm_call('set_rule_prop', {
+            'i': f'{rule_id}_w',
+            'v': rw,
+            'save': save
+        }, f'unable to set warning rule props {rule_id}_w')
+    if ra:
+        lm_call('set_rule_prop', {
+            'i': f'{rule_id}_a',
+            'v': ra,
+            'save': save
+        }, f'unable to set alarm rule props {rule_id}_a')
+    registry.invalidate_rules(i)
+
+
+def parse_bulk_specs(alarms):
+    if not isinstance(alarms, list):
+        raise pa.InvalidParameter('param "alarms" should be a list')
+    for a in alarms:
+        if not isinstance(a, dict) or not a.get('i'):
+            raise pa.InvalidParameter('alarm specs should be dicts with ids')
+    return alarms
+
+
+def run_bulk(func, items):
+    """
+    Calls func(*item) for each item concurrently
+
+    The first item element should be alarm id. Returns list of results with
+    "ok" field set to false if the function raised an exception or returned
+    False
+    """
 
+    def _run(item):
+        r = {'id': item[0]}
+        try:
+            r['ok'] = func(*item) is not False
+        except Exception as e:
+            r['ok'] = False
+            r['error'] = str(e)
+        return r
+
+    return run_concurrently(_run, items)
+
+
+def list_alarm_ids(g=None):
+    """
+    Lists ids of alarms in the group (including subgroups)
+    """
+    return [
+        alarm_id for alarm_id in registry.get()
+        if not g or alarm_id.startswith(g.strip('/') + '/')
+    ]
+
+
+def clean_rule_props(d):
+    for x in ['enabled', 'macro', 'macro_args', 'macro_kwargs', 'priority']:
+        try:
+            del d[x]
+        except KeyError:
+            pass
+    return d
+
+
+def get_alarm_rule_props(i):
+    rules = {}
+    rule_id = i.rsplit('/')[-1]
+    for rtp in ['w', 'a']:
+        result = lm_call('list_rule_props', {'i': f'{rule_id}_{rtp}'},
+                         f'unable to list rule props {rule_id}_{rtp}')
+        rules['r' + rtp] = clean_rule_props(result['data'])
+    return rules
+
+
+class AlarmRegistry:
+    """
+    In-memory alarm registry for SFA
+
+    alarm_id -> {'description': ..., 'rules': {'rw': ..., 'ra': ...}}
+
+    Alarm ids and descriptions are taken from local lvars. Rule props are
+    fetched with list_rule_props (in parallel) when requested first time and
+    cached. The registry is updated by management API methods and reloaded
+    every registry_ttl seconds. Alarm levels and statuses are always read
+    from local lvars.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.alarms = None
+        self.reloads = 0
+
+    def load(self):
+        alarms = {}
+        for lv in pa.api_call('state', p='lvar', g='alarmer/#', full=True):
+            alarms[lv['oid'].split(':', 1)[-1][8:]] = {
+                'description': lv.get('description', ''),
+                # list_rules returns a different field set, so rule props are
+                # always fetched with list_rule_props
+                'rules': None
+            }
+        with self.lock:
+            self.alarms = alarms
+            self.reloads += 1
+        logger.debug(f'alarmer registry loaded, {len(alarms)} alarms')
+
+    def get(self, rules=False):
+        if self.alarms is None:
+            self.load()
+        alarms = self.alarms
+        if rules:
+            missing = [
+                alarm_id for alarm_id, info in alarms.items()
+                if info['rules'] is None
+            ]
+
+            def _fetch(alarm_id):
+                try:
+                    return get_alarm_rule_props(alarm_id)
+                except:
+                    pa.log_traceback()
+
+            for alarm_id, props in zip(missing,
+                                       run_concurrently(_fetch, missing)):
+                if props is not None:
+                    with self.lock:
+                        info = alarms.get(alarm_id)
+                        if info is not None and info['rules'] is None:
+                            info['rules'] = props
+        return alarms
+
+    def set(self, alarm_id, description):
+        with self.lock:
+            if self.alarms is not None:
+                self.alarms[alarm_id] = {
+                    'description': description or '',
+                    'rules': None
+                }
+
+    def set_description(self, alarm_id, description):
+        with self.lock:
+            if self.alarms is not None and alarm_id in self.alarms:
+                self.alarms[alarm_id]['description'] = description
+
+    def invalidate_rules(self, alarm_id):
+        with self.lock:
+            if self.alarms is not None and alarm_id in self.alarms:
+                self.alarms[alarm_id]['rules'] = None
+
+    def remove(self, alarm_id):
+        with self.lock:
+            if self.alarms is not None:
+                self.alarms.pop(alarm_id, None)
+
+    def serialize(self):
+        alarms = self.alarms
+        return {
+            'loaded': alarms is not None,
+            'alarms': len(alarms) if alarms else 0,
+            'reloads': self.reloads
+        }
+
+
+registry = AlarmRegistry()
 
-def destroy_alarm(i):
+
+def destroy_alarm_items(i):
+    """
+    Destroys alarm lvar and rules, LM PLC controller should be reloaded after
+
+    Returns True if succeeded, otherwise False
+    """
     lvar_id = f'alarmer/{i}'
+    registry.remove(i)
+    state_cache.drop(i)
     success = True
     result = pa.api_call('management_api_call',
                          i=flags.lm,
@@ -539,8 +3229,6 @@ def destroy_alarm(i):
                          p={'i': lvar_id})
     if result['code'] != apiclient.result_ok:
         success = False
-    else:
-        pa.api_call('reload_controller', i=flags.lm)
     rule_id = i.rsplit('/', 1)[-1]
     for rtp in ['w', 'a']:
         result = pa.api_call('management_api_call',
@@ -549,19 +3237,513 @@ def destroy_alarm(i):
                              p={'i': f'{rule_id}_{rtp}'})
         if result['code'] != apiclient.result_ok:
             success = False
+    return success
+
+
+def destroy_alarm(i, reload=True):
+    success = destroy_alarm_items(i)
+    if reload:
+        pa.api_call('reload_controller', i=flags.lm)
     try:
         get_db().execute(sql('delete from alarmer_sub where alarm_id=:i'), i=i)
+        sub_index.drop(i)
     except:
         pa.log_traceback()
         success = False
     return success
 
 
+def iter_chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_alarm_subscriptions(ids):
+    """
+    Returns direct subscriptions of alarms as dict
+    alarm_id -> {(u, utp): level}
+    """
+    result = {}
+    for d in get_db().execute(
+            sql('select alarm_id, u, utp, level from alarmer_sub '
+                'where alarm_id in :ids').bindparams(
+                    sa.bindparam('ids', expanding=True)),
+            ids=ids):
+        result.setdefault(d.alarm_id, {})[(d.u, d.utp)] = d.level
+    return result
+
+
+def export_alarms(g=None, failed=None):
+    """
+    Generates alarm definitions with subscriptions, BULK_CHUNK alarms are
+    processed at once
+
+    Alarms, failed to be exported, are skipped and their ids are appended to
+    failed list (if specified)
+    """
+    alarms = registry.get()
+    for chunk in iter_chunks(sorted(list_alarm_ids(g)), BULK_CHUNK):
+        subs = get_alarm_subscriptions(chunk)
+
+        def _get_rules(alarm_id):
+            # rule props are fetched per chunk and are not cached in the
+            # registry to keep the memory usage low
+            try:
+                return get_alarm_rule_props(alarm_id)
+            except Exception as e:
+                logger.error(f'unable to export alarm {alarm_id}: {e}')
+                return False
+
+        for alarm_id, rules in zip(chunk, run_concurrently(_get_rules,
+                                                           chunk)):
+            info = alarms.get(alarm_id)
+            if info is None:
+                # destroyed during export
+                continue
+            elif rules is False:
+                if failed is not None:
+                    failed.append(alarm_id)
+                continue
+            yield {
+                'id': alarm_id,
+                'group': alarm_id.rsplit('/', 1)[0] if '/' in alarm_id else '',
+                'description': info['description'],
+                # rule ids are derived from alarm ids
+                'rw': {k: v for k, v in rules['rw'].items() if k != 'id'},
+                'ra': {k: v for k, v in rules['ra'].items() if k != 'id'},
+                'subscriptions': [{
+                    'u': u,
+                    'utp': utp,
+                    'level': level
+                } for (u, utp), level in sorted(
+                    subs.get(alarm_id, {}).items())]
+            }
+
+
+def parse_alarm_spec(spec):
+    """
+    Parses alarm definition (JSON line or dict), produced by export_alarms
+    """
+    if isinstance(spec, str):
+        spec = json.loads(spec)
+    if not isinstance(spec, dict) or not spec.get('id'):
+        raise ValueError('alarm id is required')
+    alarm_id = str(spec['id']).strip('/')
+    g, _, name = alarm_id.rpartition('/')
+    if spec.get('group') is not None and spec['group'].strip('/') != g:
+        raise ValueError('alarm group does not match alarm id')
+    for rtp in ('rw', 'ra'):
+        if not isinstance(spec.get(rtp), dict):
+            raise ValueError(f'"{rtp}" rule props are required')
+    subs = {}
+    for s in spec.get('subscriptions') or []:
+        if not isinstance(s, dict) or not s.get('u') or s.get('level') not in (
+                1, 2):
+            raise ValueError('subscriptions should be dicts with fields '
+                             'u, utp and level (1 or 2)')
+        subs[(s['u'], s.get('utp') or '')] = s['level']
+    return SimpleNamespace(id=alarm_id,
+                           g=g,
+                           name=name,
+                           description=spec.get('description') or '',
+                           rw={
+                               k: v for k, v in spec['rw'].items() if k != 'id'
+                           },
+                           ra={
+                               k: v for k, v in spec['ra'].items() if k != 'id'
+                           },
+                           subscriptions=subs)
+
+
+def import_alarms(specs, dry_run=False, save=False):
+    """
+    Imports alarm definitions with subscriptions
+
+    Alarms are created or updated, alarms and subscriptions, missing in
+    specs, are kept. Specs are processed in chunks of BULK_CHUNK, LM PLC
+    management calls are performed in parallel, the controller is reloaded
+    once. If dry_run is True, only changes are returned.
+    """
+    alarms = registry.get()
+    seen = set()
+    result = {
+        'created': 0,
+        'updated': 0,
+        'unchanged': 0,
+        'failed': 0,
+        'alarms': []
+    }
+    reload = False
+    reload_subs = False
+
+    def _diff(spec):
+        r = {'id': spec.id}
+        try:
+            return _get_changes(r, spec)
+        except Exception as e:
+            r['ok'] = False
+            r['error'] = str(e)
+            return r
+
+    def _get_changes(r, spec):
+        info = alarms.get(spec.id)
+        if info is None:
+            r['action'] = 'create'
+            return r
+        changes = {}
+        if spec.description != (info['description'] or ''):
+            changes['description'] = [info['description'], spec.description]
+        # compared with the same field set export_alarms produces
+        rules = get_alarm_rule_props(spec.id)
+        for rtp in ('rw', 'ra'):
+            props = {
+                k: [rules[rtp].get(k), v]
+                for k, v in getattr(spec, rtp).items()
+                if rules[rtp].get(k) != v
+            }
+            if props:
+                changes[rtp] = props
+        r['action'] = 'update' if changes else 'unchanged'
+        r['changes'] = changes
+        return r
+
+    def _apply(item):
+        r, spec = item
+        try:
+            if r['action'] == 'create':
+                create_alarm(spec.name, spec.description, spec.g, spec.rw,
+                             spec.ra, False)
+                registry.set(spec.id, spec.description)
+            else:
+                if 'description' in r['changes']:
+                    set_alarm_description(spec.id, spec.description, False)
+                rw = {k: v[1] for k, v in r['changes'].get('rw', {}).items()}
+                ra = {k: v[1] for k, v in r['changes'].get('ra', {}).items()}
+                if rw or ra:
+                    set_alarm_rule_props(spec.id, rw, ra, False)
+            r['ok'] = True
+        except Exception as e:
+            # failed creation is rolled back by create_alarm, if the registry
+            # is stale and the alarm exists, it is kept untouched
+            r['ok'] = False
+            r['error'] = str(e)
+
+    try:
+        for chunk in iter_chunks(enumerate(specs, 1), BULK_CHUNK):
+            parsed = []
+            for n, spec in chunk:
+                if isinstance(spec, str) and not spec.strip():
+                    continue
+                try:
+                    spec = parse_alarm_spec(spec)
+                    # rule ids are derived from alarm ids without groups
+                    if spec.name in seen:
+                        raise ValueError('duplicate alarm id')
+                except Exception as e:
+                    result['failed'] += 1
+                    result['alarms'].append({
+                        'line': n,
+                        'ok': False,
+                        'error': str(e)
+                    })
+                    continue
+                seen.add(spec.name)
+                parsed.append(spec)
+            if not parsed:
+                continue
+            subs = get_alarm_subscriptions([spec.id for spec in parsed])
+            items = []
+            for r, spec in zip(run_concurrently(_diff, parsed), parsed):
+                if r.get('ok') is False:
+                    result['failed'] += 1
+                    result['alarms'].append(r)
+                    continue
+                current = subs.get(spec.id, {})
+                sub_changes = [{
+                    'u': u,
+                    'utp': utp,
+                    'level': [current.get((u, utp)), level]
+                }
+                               for (u, utp), level in spec.subscriptions.items()
+                               if current.get((u, utp)) != level]
+                if sub_changes:
+                    r.setdefault('changes', {})['subscriptions'] = sub_changes
+                    if r['action'] == 'unchanged':
+                        r['action'] = 'update'
+                if r['action'] != 'unchanged':
+                    items.append((r, spec))
+                else:
+                    result['unchanged'] += 1
+            if not dry_run and items:
+                reload = True
+                run_concurrently(_apply, items)
+                rows = []
+                for r, _ in items:
+                    if r['ok']:
+                        for s in r.get('changes', {}).get('subscriptions', []):
+                            rows.append({
+                                'alarm_id': r['id'],
+                                'u': s['u'],
+                                'utp': s['utp'],
+                                'level': s['level'][1]
+                            })
+                if rows:
+                    try:
+                        db = get_db()
+                        with db.begin():
+                            db.execute(
+                                sql('delete from alarmer_sub where u=:u '
+                                    'and utp=:utp and alarm_id=:alarm_id'),
+                                rows)
+                            db.execute(
+                                sql('insert into alarmer_sub(u, utp, '
+                                    'alarm_id, level) '
+                                    'values (:u, :utp, :alarm_id, :level)'),
+                                rows)
+                        reload_subs = True
+                    except Exception as e:
+                        pa.log_traceback()
+                        reset_db()
+                        ids = {x['alarm_id'] for x in rows}
+                        for r, _ in items:
+                            if r['id'] in ids:
+                                r['ok'] = False
+                                r['error'] = ('unable to write subscriptions: '
+                                              f'{e}')
+            for r, _ in items:
+                if r.get('ok') is False:
+                    result['failed'] += 1
+                else:
+                    result['created' if r['action'] == 'create' else
+                           'updated'] += 1
+                result['alarms'].append(r)
+    finally:
+        # the controller is reloaded even if the import has been interrupted
+        if reload:
+            if save:
+                lm_call('save', {}, 'unable to save configuration')
+            pa.api_call('reload_controller', i=flags.lm)
+        if reload_subs:
+            sub_index.load()
+    return result
+
+
+def parse_retention(value, tp):
+    result = []
+    if value:
+        for x in value.split(','):
+            x = x.strip()
+            if x:
+                k, v = x.rsplit(':', 1)
+                result.append((tp(k.strip()), int(v)))
+    return result
+
+
+def like_escape(s):
+    return s.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+
+def get_retention_rules(groups, levels):
+    """
+    Returns list of (condition, params, keep) log retention rules
+
+    Each record is covered by the first matching rule only: group rules (the
+    most specific group first), then level rules, then the default one
+    """
+    matches = []
+    params = {}
+    for n, (grp, keep) in enumerate(
+            sorted(groups, key=lambda x: len(x[0]), reverse=True)):
+        matches.append((f"alarm_id like :g{n} escape '!'", keep))
+        params[f'g{n}'] = like_escape(grp.strip('/')) + '/%'
+    for n, (level, keep) in enumerate(levels):
+        matches.append((f'level=:l{n}', keep))
+        params[f'l{n}'] = level
+    rules = []
+    for n, (cond, keep) in enumerate(matches):
+        rules.append((' and '.join([cond] +
+                                   [f'not ({c})' for c, _ in matches[:n]]),
+                      params, keep))
+    rules.append((' and '.join([f'not ({c})' for c, _ in matches]) or '1=1',
+                  params, flags.keep_log))
+    return rules
+
+
+class LogCleanerStats:
+
+    def __init__(self):
+        self.purged = 0
+        self.archived = 0
+        self.runs = 0
+        self.last_purged = 0
+        self.last_time = 0
+        self.total_time = 0
+
+    def serialize(self):
+        return self.__dict__.copy()
+
+
+log_cleaner_stats = LogCleanerStats()
+
+
+def archive_log_records(records):
+    import gzip
+    import glob
+    import os
+    fname = os.path.join(
+        flags.log_archive,
+        f'alarmer_log.{time.strftime("%Y%m%d", time.localtime())}.jsonl.gz')
+    with gzip.open(fname, 'at') as fh:
+        for r in records:
+            fh.write(json.dumps(r) + '\n')
+    files = sorted(
+        glob.glob(os.path.join(flags.log_archive, 'alarmer_log.*.jsonl.gz')))
+    for f in files[:-flags.log_archive_keep]:
+        logger.debug(f'removing alarm log archive {f}')
+        os.unlink(f)
+
+
+def clean_log_chunk(db, cond, params, t):
+    """
+    Deletes (and optionally archives) a chunk of expired log records
+
+    Returns number of records deleted
+    """
+    fields = ('id, u, utp, key_id, alarm_id, description, action, t, level, '
+              'hits' if flags.log_archive else 'id')
+    records = db.execute(
+        sql(f'select {fields} from alarmer_log where t<:t and {cond} '
+            'order by t limit :n'),
+        t=t,
+        n=flags.log_clean_chunk,
+        **params).fetchall()
+    if not records:
+        return 0
+    if flags.log_archive:
+        archive_log_records([dict(r) for r in records])
+        log_cleaner_stats.archived += len(records)
+    db.execute(
+        sql('delete from alarmer_log where id in :ids').bindparams(
+            sa.bindparam('ids', expanding=True)),
+        ids=[r.id for r in records])
+    return len(records)
+
+
 @background_worker(delay=60,
                    name='alarmer:log_cleaner',
                    loop='cleaners',
                    on_error=pa.log_traceback)
 async def log_cleaner(**kwargs):
+    import asyncio
     logger.debug('cleaning alarmer_log')
-    get_db().execute(sql('delete from alarmer_log where t<:t'),
-                     t=time.time() - flags.keep_log)
+    t_start = time.perf_counter()
+    purged = 0
+    db = get_db()
+    now = time.time()
+    try:
+        for cond, params, keep in flags.keep_log_rules:
+            while log_cleaner.is_active():
+                n = clean_log_chunk(db, cond, params, now - keep)
+                purged += n
+                log_cleaner_stats.purged += n
+                if n < flags.log_clean_chunk:
+                    break
+                await asyncio.sleep(flags.log_clean_pause)
+        n = stats_rollup.clean(db, now)
+        if n:
+            logger.debug(f'alarmer_stats: {n} expired rollups purged')
+    finally:
+        t = time.perf_counter() - t_start
+        metrics.observe('alarmer_log_clean_seconds', t)
+        log_cleaner_stats.runs += 1
+        log_cleaner_stats.last_purged = purged
+        log_cleaner_stats.last_time = t
+        log_cleaner_stats.total_time += t
+        if purged:
+            logger.debug(f'alarmer_log: {purged} records purged in {t:.3f}s')
+
+
+@background_worker(delay=1,
+                   name='alarmer:digest_flusher',
+                   loop='cleaners',
+                   on_error=pa.log_traceback)
+def digest_flusher(**kwargs):
+    digest.flush()
+
+
+@background_worker(delay=30,
+                   name='alarmer:sub_index_reloader',
+                   loop='cleaners',
+                   on_error=pa.log_traceback)
+def sub_index_reloader(**kwargs):
+    sub_index.load()
+
+
+@background_worker(delay=0.1,
+                   name='alarmer:log_migrator',
+                   loop='cleaners',
+                   on_error=pa.log_traceback)
+def log_migrator(**kwargs):
+    """
+    Moves records from the old-style log table in chunks, so the database is
+    not locked for a long time if the log is large
+    """
+    db = get_db()
+    # the old table has no row id and may contain NULLs (e.g. key_id of acks),
+    # so records are moved by time ranges, NULLs are replaced with defaults
+    r = db.execute(sql('select coalesce(t, 0) as t from alarmer_log_v0 '
+                       'order by coalesce(t, 0) limit 1 offset :n'),
+                   n=MIGRATE_CHUNK - 1).fetchone()
+    if r is None:
+        r = db.execute(sql('select max(coalesce(t, 0)) as t '
+                           'from alarmer_log_v0')).fetchone()
+    t = r.t if r else None
+    if t is not None:
+        with db.begin():
+            moved = db.execute(
+                sql('insert into alarmer_log'
+                    '(u, utp, key_id, alarm_id, description, action, t, level) '
+                    "select coalesce(u, ''), coalesce(utp, ''), "
+                    "coalesce(key_id, ''), coalesce(alarm_id, ''), "
+                    "coalesce(description, ''), coalesce(action, ''), "
+                    'coalesce(t, 0), coalesce(level, 0) from alarmer_log_v0 '
+                    'where coalesce(t, 0)<=:t'),
+                t=t).rowcount
+            db.execute(
+                sql('delete from alarmer_log_v0 where coalesce(t, 0)<=:t'),
+                t=t)
+        logger.debug(f'alarmer_log migration: {moved} records moved')
+    else:
+        db.execute(sql('drop table alarmer_log_v0'))
+        set_schema_version(db, SCHEMA_VERSION)
+        flags.migrate_log = False
+        logger.warning('alarmer_log migration completed')
+        return False
+
+
+@background_worker(delay=300,
+                   name='alarmer:registry_reloader',
+                   loop='cleaners',
+                   on_error=pa.log_traceback)
+def registry_reloader(**kwargs):
+    registry.load()
+
+
+@background_worker(delay=5,
+                   name='alarmer:spool_retrier',
+                   loop='cleaners',
+                   on_error=pa.log_traceback)
+def spool_retrier(**kwargs):
+    spool.requeue()
+
+
+@background_worker(delay=15,
+                   name='alarmer:metrics_writer',
+                   loop='cleaners',
+                   on_error=pa.log_traceback)
+def metrics_writer(**kwargs):
+    metrics.write(flags.metrics_file)
@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+"""
+alarmer benchmark
+
+Runs alarmer.py with stand-ins of EVA ICS plugin API, mailer and LM PLC
+management API (see bench/stubs) on a temporary SQLite database, filled with
+generated subscriptions and alarm log records, and reports throughput and
+latency percentiles of the plugin operations.
+
+LM PLC benchmarks: log_cleaner, notify, ack, subscribe, get_log
+SFA benchmarks: create, create_many, list
+
+Each product is benchmarked in a separate process. Plugin config options can
+be set with --set, e.g. --set notify_workers=4 --set metrics=true
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(BENCH_DIR, 'stubs'))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+BENCHMARKS = {
+    'lm': ('log_cleaner', 'notify', 'ack', 'subscribe', 'get_log'),
+    'sfa': ('create', 'create_many', 'set_description_many', 'import', 'list')
+}
+
+GROUP = 'bench'
+
+
+def measure(func, n, threads=1, rate=0, prepare=None):
+    """
+    Calls func(i) n times by the specified number of threads
+
+    If rate is set, calls are started not faster than rate per second.
+    prepare(i) is called before func(i) and is not measured.
+
+    Returns tuple (elapsed time, list of call latencies)
+    """
+    latencies = [0] * n
+    counter = itertools.count()
+    t_start = time.perf_counter()
+
+    def worker():
+        while True:
+            i = next(counter)
+            if i >= n:
+                break
+            if prepare:
+                prepare(i)
+            if rate:
+                delay = t_start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            t = time.perf_counter()
+            func(i)
+            latencies[i] = time.perf_counter() - t
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - t_start, latencies
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def result(name, n, elapsed, latencies=None, **extra):
+    r = {
+        'name': name,
+        'n': n,
+        'elapsed': elapsed,
+        'throughput': n / elapsed if elapsed else None,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None
+    }
+    r.update(extra)
+    return r
+
+
+def alarm_ids(args):
+    return [f'{GROUP}/a{n}' for n in range(args.alarms)]
+
+
+def create_fixtures(db, args):
+    """
+    Creates userinfo records of subscribers
+    """
+    import sqlalchemy as sa
+    engine = sa.create_engine(f'sqlite:///{db}')
+    engine.execute('create table userinfo(u varchar(128), utp varchar(32), '
+                   'name varchar(64), value varchar(256))')
+    engine.execute(
+        sa.text('insert into userinfo values (:u, \'\', \'email\', :email)'),
+        [{
+            'u': f'u{n}',
+            'email': f'u{n}@bench.local'
+        } for n in range(args.subscribers)])
+    engine.dispose()
+
+
+def fill_db(alarmer, args):
+    """
+    Fills subscriptions and alarm log, half of log records are expired
+    """
+    db = alarmer.get_db()
+    now = time.time()
+    keep_log = alarmer.flags.keep_log
+    with db.begin():
+        db.execute(
+            alarmer.sql('insert into alarmer_sub(u, utp, alarm_id, level) '
+                        'values (:u, \'\', :alarm_id, :level)'),
+            [{
+                'u': f'u{n}',
+                'alarm_id': alarm_id,
+                'level': 1 + n % 2
+            } for alarm_id in alarm_ids(args)
+             for n in range(args.subscribers)])
+    ids = alarm_ids(args)
+    for n in range(0, args.log_size, 10000):
+        records = [{
+            'alarm_id': random.choice(ids),
+            'action': 'T' if x % 2 else 'A',
+            't': now - random.random() * keep_log * 2,
+            'level': 1 + x % 2 if x % 2 else 0
+        } for x in range(min(10000, args.log_size - n))]
+        with db.begin():
+            db.execute(
+                alarmer.sql(
+                    'insert into alarmer_log(u, utp, key_id, alarm_id, '
+                    'description, action, t, level) '
+                    'values (\'\', \'\', \'\', :alarm_id, \'\', :action, :t, '
+                    ':level)'), records)
+
+
+def wait_delivered(alarmer, timeout=300):
+    t_end = time.monotonic() + timeout
+    while time.monotonic() < t_end:
+        if not any(c.dispatcher.qsize() for c in alarmer.channels.values()) \
+                and not alarmer.spool.inflight:
+            return
+        time.sleep(0.01)
+    raise TimeoutError('notifications are not delivered')
+
+
+def run_lm(alarmer, args, config):
+    import eva.pluginapi as pa
+    import eva.mailer
+    from neotasker import task_supervisor
+    results = []
+    selected = [b for b in BENCHMARKS['lm'] if b in args.benchmarks]
+    ids = alarm_ids(args)
+    for alarm_id in ids:
+        oid = f'lvar:alarmer/{alarm_id}'
+        pa.items[oid] = pa.Item(oid)
+        pa.items[oid].description = f'alarm {alarm_id}'
+    alarmer.init(config)
+    alarmer.before_start()
+    fill_db(alarmer, args)
+    alarmer.sub_index.load()
+    api = pa.apix[0]
+    alarmer.start()
+    try:
+        # the log cleaner starts immediately
+        while not alarmer.log_cleaner_stats.runs:
+            time.sleep(0.01)
+        if 'log_cleaner' in selected:
+            st = alarmer.log_cleaner_stats
+            results.append(
+                result('log_cleaner', st.purged, st.total_time,
+                       log_size=args.log_size))
+        if 'notify' in selected:
+
+            def reset_alarm(i):
+                alarm_id = ids[i % len(ids)]
+                pa.items[f'lvar:alarmer/{alarm_id}'].value = ''
+                alarmer.state_cache.set_value(alarm_id, '')
+
+            mails = eva.mailer.sent
+            t_start = time.perf_counter()
+            elapsed, latencies = measure(
+                lambda i: alarmer.notify(ids[i % len(ids)], 2),
+                args.n,
+                threads=args.threads,
+                rate=args.rate,
+                prepare=reset_alarm)
+            results.append(result('notify', args.n, elapsed, latencies))
+            wait_delivered(alarmer)
+            results.append(
+                result('notify (delivered)',
+                       args.n,
+                       time.perf_counter() - t_start,
+                       emails=eva.mailer.sent - mails))
+        if 'ack' in selected:
+
+            def trigger_alarm(i):
+                alarm_id = ids[i % len(ids)]
+                pa.items[f'lvar:alarmer/{alarm_id}'].value = '2'
+                alarmer.state_cache.set_value(alarm_id, '2')
+
+            def ack(i):
+                # API call info is thread-local
+                pa.aci.u = f'u{i % args.subscribers}'
+                pa.aci.utp = ''
+                pa.aci.key_id = GROUP
+                api.ack(k=GROUP, i=ids[i % len(ids)])
+
+            elapsed, latencies = measure(ack,
+                                         args.n,
+                                         rate=args.rate,
+                                         prepare=trigger_alarm)
+            results.append(result('ack', args.n, elapsed, latencies))
+        if 'subscribe' in selected:
+
+            def subscribe(i):
+                pa.aci.u = f'u{i % args.subscribers}'
+                pa.aci.utp = ''
+                pa.aci.key_id = GROUP
+                api.subscribe(k=GROUP, i=ids[i % len(ids)], l=1 + i % 2)
+
+            elapsed, latencies = measure(subscribe,
+                                         args.n,
+                                         threads=args.threads,
+                                         rate=args.rate)
+            results.append(result('subscribe', args.n, elapsed, latencies))
+        if 'get_log' in selected:
+            alarmer.log_writer.flush()
+            elapsed, latencies = measure(
+                lambda i: api.get_log(k=GROUP, i=ids[i % len(ids)], n=100),
+                args.n,
+                threads=args.threads,
+                rate=args.rate)
+            results.append(result('get_log', args.n, elapsed, latencies))
+    finally:
+        alarmer.stop()
+        task_supervisor.stop(wait=True)
+    return results
+
+
+def run_sfa(alarmer, args, config):
+    import eva.pluginapi as pa
+    from neotasker import task_supervisor
+    results = []
+    selected = [b for b in BENCHMARKS['sfa'] if b in args.benchmarks]
+    pa.product.code = 'sfa'
+    config['lm'] = 'bench'
+    alarmer.init(config)
+    alarmer.before_start()
+    api = pa.apix[0]
+    alarmer.start()
+    rule = {'for_oid': 'sensor:bench/s1', 'for_prop': 'value'}
+    try:
+        if 'create' in selected:
+            elapsed, latencies = measure(
+                lambda i: api.create(u=f'c{i}',
+                                     d=f'alarm c{i}',
+                                     g=f'{GROUP}/create',
+                                     w=rule,
+                                     a=rule,
+                                     save=False),
+                args.n,
+                threads=args.threads,
+                rate=args.rate)
+            results.append(result('create', args.n, elapsed, latencies))
+        if 'create_many' in selected:
+            batches = max(1, args.n // args.batch)
+            elapsed, latencies = measure(
+                lambda i: api.create_many(alarms=[{
+                    'u': f'm{i}_{n}',
+                    'd': f'alarm m{i}_{n}',
+                    'g': f'{GROUP}/create_many',
+                    'w': rule,
+                    'a': rule
+                } for n in range(args.batch)],
+                                          save=False), batches)
+            results.append(
+                result('create_many',
+                       batches * args.batch,
+                       elapsed,
+                       latencies,
+                       batch=args.batch))
+        if 'set_description_many' in selected or 'import' in selected:
+            api.create_many(alarms=[{
+                'u': f'u{n}',
+                'd': f'alarm u{n}',
+                'g': f'{GROUP}/update',
+                'w': rule,
+                'a': rule
+            } for n in range(args.batch)],
+                            save=False)
+            batches = max(1, args.n // args.batch)
+        if 'set_description_many' in selected:
+            elapsed, latencies = measure(
+                lambda i: api.set_description_many(alarms=[{
+                    'i': f'{GROUP}/update/u{n}',
+                    'd': f'alarm u{n} ({i})'
+                } for n in range(args.batch)],
+                                                   save=False), batches)
+            results.append(
+                result('set_description_many',
+                       batches * args.batch,
+                       elapsed,
+                       latencies,
+                       batch=args.batch))
+        if 'import' in selected:
+            data = api.export(g=f'{GROUP}/update').splitlines()
+            # each import changes descriptions of all alarms
+            elapsed, latencies = measure(
+                lambda i: api._import(data=[
+                    dict(json.loads(x), description=f'imported {i}')
+                    for x in data
+                ],
+                                      save=False), batches)
+            results.append(
+                result('import',
+                       batches * len(data),
+                       elapsed,
+                       latencies,
+                       batch=len(data)))
+        if 'list' in selected:
+            alarmer.registry.load()
+            elapsed, latencies = measure(lambda i: api.list(k=GROUP),
+                                         args.n,
+                                         threads=args.threads,
+                                         rate=args.rate)
+            results.append(
+                result('list',
+                       args.n,
+                       elapsed,
+                       latencies,
+                       alarms=len(alarmer.registry.get())))
+    finally:
+        alarmer.stop()
+        task_supervisor.stop(wait=True)
+    return results
+
+
+def run_product(args):
+    """
+    Runs benchmarks of the product in the current process, prints results
+    as JSON
+    """
+    import eva.mailer
+    import eva.pluginapi as pa
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+    eva.mailer.delay = args.mail_delay
+    pa.lm_delay = args.lm_delay
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = os.path.join(tmpdir, 'alarmer.db')
+        create_fixtures(db, args)
+        config = {'db': db, 'keep_log': '86400'}
+        for opt in args.set:
+            k, v = opt.split('=', 1)
+            config[k.strip()] = v.strip()
+        import alarmer
+        from neotasker import task_supervisor
+        task_supervisor.start()
+        task_supervisor.create_aloop('cleaners')
+        if args.product == 'lm':
+            results = run_lm(alarmer, args, config)
+        else:
+            results = run_sfa(alarmer, args, config)
+    print(json.dumps(results))
+
+
+def format_results(args, results):
+    lines = [
+        f'alarmer benchmark: n={args.n} threads={args.threads} '
+        f'rate={args.rate or "max"} alarms={args.alarms} '
+        f'subscribers={args.subscribers} log_size={args.log_size} '
+        f'mail_delay={args.mail_delay} lm_delay={args.lm_delay} '
+        f'set={",".join(args.set) or "-"}', '',
+        f'{"benchmark":<20} {"ops":>8} {"time,s":>9} {"ops/s":>10} '
+        f'{"p50,ms":>9} {"p99,ms":>9} {"max,ms":>9}'
+    ]
+
+    def ms(v):
+        return f'{v * 1000:9.3f}' if v is not None else f'{"-":>9}'
+
+    for r in results:
+        extra = ', '.join(f'{k}={v}'
+                          for k, v in r.items()
+                          if k not in ('name', 'n', 'elapsed', 'throughput',
+                                       'p50', 'p99', 'max'))
+        tp = r['throughput']
+        lines.append(f'{r["name"]:<20} {r["n"]:>8} {r["elapsed"]:9.3f} '
+                     f'{tp if tp is not None else 0:10.1f} {ms(r["p50"])} '
+                     f'{ms(r["p99"])} {ms(r["max"])}'
+                     f'{"  " + extra if extra else ""}')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    ap = argparse.ArgumentParser(description='alarmer benchmark')
+    ap.add_argument('benchmarks',
+                    nargs='*',
+                    metavar='BENCHMARK',
+                    help='benchmarks to run (default: all)')
+    ap.add_argument('-n', type=int, default=1000, help='operations per test')
+    ap.add_argument('--threads',
+                    type=int,
+                    default=1,
+                    help='concurrent callers')
+    ap.add_argument('--rate',
+                    type=float,
+                    default=0,
+                    help='max operations per second (default: no limit)')
+    ap.add_argument('--alarms', type=int, default=100, help='number of alarms')
+    ap.add_argument('--subscribers',
+                    type=int,
+                    default=10,
+                    help='subscribers per alarm')
+    ap.add_argument('--log-size',
+                    type=int,
+                    default=100000,
+                    help='alarm log records (half of them expired)')
+    ap.add_argument('--batch',
+                    type=int,
+                    default=100,
+                    help='alarms per create_many call')
+    ap.add_argument('--mail-delay',
+                    type=float,
+                    default=0,
+                    help='emulated mailer latency (seconds)')
+    ap.add_argument('--lm-delay',
+                    type=float,
+                    default=0,
+                    help='emulated LM PLC management API latency (seconds)')
+    ap.add_argument('--set',
+                    action='append',
+                    default=[],
+                    metavar='OPTION=VALUE',
+                    help='plugin config option')
+    ap.add_argument('-o',
+                    '--output',
+                    metavar='FILE',
+                    help='append report to file')
+    ap.add_argument('-v', '--verbose', action='store_true')
+    ap.add_argument('--product', choices=('lm', 'sfa'), help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    all_benchmarks = BENCHMARKS['lm'] + BENCHMARKS['sfa']
+    if not args.benchmarks:
+        args.benchmarks = list(all_benchmarks)
+    for b in args.benchmarks:
+        if b not in all_benchmarks:
+            ap.error(f'unknown benchmark: {b}')
+    if args.product:
+        run_product(args)
+        return
+    results = []
+    for product, benchmarks in BENCHMARKS.items():
+        if any(b in args.benchmarks for b in benchmarks):
+            out = subprocess.run(
+                [sys.executable, __file__, '--product', product] +
+                sys.argv[1:],
+                stdout=subprocess.PIPE,
+                check=True).stdout.decode()
+            results += json.loads(out.strip().splitlines()[-1])
+    report = format_results(args, results)
+    print(report, end='')
+    if args.output:
+        with open(args.output, 'a') as fh:
+            fh.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+"""
+Stand-in of eva.client.apiclient (result codes only)
+"""
+
+result_ok = 0
+result_not_found = 1
+result_func_failed = 6
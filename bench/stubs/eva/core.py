@@ -0,0 +1,19 @@
+"""
+Stand-in of eva.core for benchmarks
+"""
+
+import sqlalchemy as sa
+
+from types import SimpleNamespace
+
+config = SimpleNamespace(system_name='bench')
+
+
+def format_db_uri(db):
+    if db.find('://') == -1:
+        return 'sqlite:///' + db
+    return db
+
+
+def create_db_engine(db_uri, timeout=None):
+    return sa.create_engine(db_uri)
@@ -0,0 +1,24 @@
+"""
+Stand-in of eva.mailer for benchmarks
+
+Emails are not sent, the mailer just counts them, optionally sleeping for
+"delay" seconds to emulate SMTP server latency
+"""
+
+import threading
+import time
+
+delay = 0
+sent = 0
+recipients = 0
+
+_lock = threading.Lock()
+
+
+def send(subject=None, text=None, rcp=None):
+    global sent, recipients
+    if delay:
+        time.sleep(delay)
+    with _lock:
+        sent += 1
+        recipients += len(rcp) if rcp else 0
@@ -0,0 +1,203 @@
+"""
+Stand-in of eva.pluginapi for benchmarks
+
+Items are kept in memory, "state", "set" and "clear" API calls work with
+them. LM PLC management API calls are emulated with optional "lm_delay"
+latency, all access checks pass.
+"""
+
+import logging
+import threading
+import time
+import traceback
+
+from types import SimpleNamespace
+
+
+class FunctionFailed(Exception):
+    pass
+
+
+class ResourceNotFound(Exception):
+    pass
+
+
+class AccessDenied(Exception):
+    pass
+
+
+class InvalidParameter(Exception):
+    pass
+
+
+product = SimpleNamespace(code='lm')
+
+# oid -> Item
+items = {}
+# LM PLC rules
+rules = {}
+
+lm_delay = 0
+
+aci = threading.local()
+
+
+class APIX:
+    pass
+
+
+class Item:
+
+    def __init__(self, oid):
+        self.oid = oid
+        self.item_type, self.full_id = oid.split(':', 1)
+        self.group, self.item_id = self.full_id.rsplit('/', 1)
+        self.status = 1
+        self.value = ''
+        self.description = ''
+
+    def serialize(self, full=False, **kwargs):
+        return {
+            'oid': self.oid,
+            'full_id': self.full_id,
+            'group': self.group,
+            'id': self.item_id,
+            'type': self.item_type,
+            'status': self.status,
+            'value': self.value,
+            'description': self.description
+        }
+
+
+def get_logger():
+    return logging.getLogger('alarmer')
+
+
+def log_traceback():
+    traceback.print_exc()
+
+
+def get_product():
+    return product
+
+
+apix = []
+lmacro = {}
+
+
+def register_apix(o, sys_api=False):
+    apix.append(o)
+
+
+def register_lmacro_object(n, o):
+    lmacro[n] = o
+
+
+def api_log_d(f):
+    return f
+
+
+api_log_i = api_log_w = api_need_master = api_log_d
+
+
+def get_aci(k):
+    return getattr(aci, k, None)
+
+
+def key_check(k, item=None, ro_op=False, master=False):
+    return True
+
+
+def get_item(oid):
+    return items.get(oid)
+
+
+def _convert(v, tp):
+    if v is None:
+        return None
+    if tp == 'i':
+        return int(v)
+    if tp == 'f':
+        return float(v)
+    if tp == 'b':
+        return bool(v)
+    return v
+
+
+def parse_function_params(params, names, types='', defaults=None):
+    if isinstance(names, str):
+        names = ['save' if n == 'S' else n for n in names]
+    result = []
+    for n, tp in zip(names, types):
+        v = params.get(n)
+        if tp in 'SIR' and v is None:
+            raise InvalidParameter(f'param "{n}" is required')
+        result.append(_convert(v, tp.lower()))
+    return result[0] if len(result) == 1 else result
+
+
+parse_api_params = parse_function_params
+
+
+def _lvar_oid(i):
+    # LM accepts both full oids and lvar ids
+    return i if i.startswith('lvar:') else 'lvar:' + i
+
+
+def _management_call(f, p):
+    if lm_delay:
+        time.sleep(lm_delay)
+    if f == 'create_lvar':
+        oid = _lvar_oid(p['i'])
+        if oid in items:
+            return {'code': 1}
+        items[oid] = Item(oid)
+    elif f == 'destroy_lvar':
+        items.pop(_lvar_oid(p['i']), None)
+    elif f == 'set_prop':
+        item = items.get(_lvar_oid(p['i']))
+        if not item:
+            return {'code': 1}
+        setattr(item, p['p'], p['v'])
+    elif f == 'create_rule':
+        if p['u'] in rules:
+            return {'code': 1}
+        rules[p['u']] = dict(p.get('v') or {}, id=p['u'])
+    elif f == 'set_rule_prop':
+        try:
+            if p.get('p'):
+                rules[p['i']][p['p']] = p['v']
+            else:
+                rules[p['i']].update(p['v'])
+        except KeyError:
+            return {'code': 1}
+    elif f == 'destroy_rule':
+        rules.pop(p['i'], None)
+    elif f == 'list_rules':
+        return {'code': 0, 'data': list(rules.values())}
+    elif f == 'list_rule_props':
+        try:
+            return {'code': 0, 'data': dict(rules[p['i']])}
+        except KeyError:
+            return {'code': 1}
+    return {'code': 0, 'data': {}}
+
+
+def api_call(method, **kwargs):
+    if method == 'state':
+        if 'i' in kwargs:
+            return items[kwargs['i']].serialize()
+        g = kwargs.get('g', '').rstrip('#').rstrip('/')
+        return [
+            x.serialize()
+            for x in list(items.values())
+            if x.item_type == kwargs.get('p') and
+            (not g or x.group == g or x.group.startswith(g + '/'))
+        ]
+    elif method == 'set':
+        items[kwargs['i']].value = str(kwargs.get('v'))
+    elif method == 'clear':
+        items[kwargs['i']].value = '0'
+    elif method == 'management_api_call':
+        return _management_call(kwargs['f'], kwargs.get('p', {}))
+    return True